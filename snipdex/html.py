@@ -164,7 +164,7 @@ def basic_render(query_param, peer_list, snippet_list):
     #    result += self.default_renderer.render(origin_list[origin_id])
 
     page = 1 
-    max_page = min(10, 1 + int((len(snippet_list) - 1) / 10))
+    max_page = min(snipdata.SNIPPET_MAX_PAGES, 1 + int((len(snippet_list) - 1) / snipdata.SNIPPET_PAGE_SIZE))
     try:
        page = int(query_param['p'])
     except (KeyError, ValueError):
@@ -173,16 +173,17 @@ def basic_render(query_param, peer_list, snippet_list):
         page = 1
     if page > max_page:
         page = max_page
-    first = (page - 1) * 10 # 10 results per page
-    last = first + 10  
+    first = (page - 1) * snipdata.SNIPPET_PAGE_SIZE
+    last = first + snipdata.SNIPPET_PAGE_SIZE
     render_snippet_list = snippet_list[first:last]
 
     result = give_status_line(page, peer_by_id, snippet_list)
 
     if page == 1:
+        query_text = query_param.normalized().text
         for (peer, status, score) in peer_list:
             if status != 'TODO' and peer.query_hints:
-                if query_param.normalized_text() in peer.query_hints and peer.name and peer.html_template:
+                if query_text in peer.query_hints and peer.name and peer.html_template:
                     result += html_full_peer_render(peer)
 
     for snippet in render_snippet_list:
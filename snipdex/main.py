@@ -17,10 +17,10 @@ import logging
 import signal
 
 from optparse import OptionParser
-from BaseHTTPServer import HTTPServer 
 
 # Snipdex local imports
 import receiver
+import snipdata
 
 SNIPDEX_PEER_VERSION = '0.3'
 
@@ -49,6 +49,23 @@ parser.add_option("-l", "--web-location", action="store", type="string",
 parser.add_option("-c", "--cache-file", action="store", type="string",
                   dest="cache_file",
                   help="File-name that contains the cached search results.")
+parser.add_option("-s", "--cache-durability", action="store", dest="cache_durability",
+                  help="Durability of cache writes (default: normal)",
+                  choices=["off", "normal", "full"])
+parser.add_option("-f", "--fresh-minutes", action="store", type="int", dest="fresh_minutes",
+                  help="Serve cached results up to this age without searching (default: 60)")
+parser.add_option("-e", "--stale-minutes", action="store", type="int", dest="stale_minutes",
+                  help="Serve cached results up to this age while searching in the background (default: 10080)")
+parser.add_option("-n", "--cache-shards", action="store", type="int", dest="cache_shards",
+                  help="Split the cache into this many files, so searches write in parallel (default: 1)")
+parser.add_option("-i", "--statistics-minutes", action="store", type="int", dest="statistics_minutes",
+                  help="Log cache statistics every so many minutes (default: 0, never)")
+parser.add_option("-r", "--near-duplicate-bits", action="store", type="int", dest="near_duplicate_bits",
+                  help="Merge results with almost the same title and summary: SimHashes that differ "
+                       "in at most this many bits (default: off, try 3)")
+parser.add_option("-g", "--fusion", action="store", dest="fusion",
+                  help="Rank the results of peers by score (default: round robin)",
+                  choices=sorted(snipdata.SNIPPET_FUSIONS))
 
 
 # We assume the main script is not imported.
@@ -85,9 +102,13 @@ default_cache  = cache_file
 # Set defaults & parse
 parser.set_defaults(peer_port=8472, 
                     mother_server=mother_server, mother_port=mother_port,
-                    web_location=webroot, cache_file=cache_file,
+                    web_location=webroot, cache_file=cache_file, cache_durability="normal",
+                    fresh_minutes=snipdata.CACHE_FRESH_SECONDS / 60, stale_minutes=snipdata.CACHE_STALE_SECONDS / 60,
+                    cache_shards=1, statistics_minutes=0, near_duplicate_bits=None,
                     no_pitch=False, monitor=False, web="private")
 (options, args) = parser.parse_args()
+if options.near_duplicate_bits is not None and not 0 <= options.near_duplicate_bits < 64:
+    parser.error("option -r: the number of bits must be from 0 to 63")
 
 # Get mother address and its cache file
 if options.mother_server == 'localhost':
@@ -113,13 +134,17 @@ logger.debug("Mother's public address: " + options.mother_server + ":" + str(opt
 
 # Run web server 
 command_handler = receiver.PeerCommandHandler(options.peer_port, options.mother_server, options.mother_port, 
-                                              options.web_location, options.cache_file, logger)
+                                              options.web_location, options.cache_file, logger,
+                                              options.cache_durability, 
+                                              options.fresh_minutes * 60, options.stale_minutes * 60,
+                                              options.cache_shards, options.statistics_minutes * 60,
+                                              options.near_duplicate_bits, options.fusion)
 
 if not options.debug:
     receiver.PeerRequestHandler.log_message = lambda *args: None  # no logging
 receiver.PeerRequestHandler.command_handler = command_handler
 try:
-    server = HTTPServer(('', options.peer_port), receiver.PeerRequestHandler)
+    server = receiver.PeerHTTPServer(('', options.peer_port), receiver.PeerRequestHandler)
 except receiver.sender.httplib.socket.error as ex:
     sys.stderr.write("Error: SnipDex already running? " + repr(ex) + '\n')
     exit(1)
@@ -130,6 +155,7 @@ def cleanup(*args):
     (Python would garbage collect some of this, but it isn't guaranteed)
     """
     logger.info("Okay, exiting.")
+    command_handler.close()
     exit(0)
 
 signal.signal(signal.SIGINT, cleanup)
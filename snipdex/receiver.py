@@ -23,12 +23,14 @@ Authors: Almer Tigelaar
 """
 
 import os
+import urllib
 import urlparse 
 import socket
 import BaseHTTPServer
 import time
 
-from threading import Thread
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
 from string import Template
 
 # local imports
@@ -36,6 +38,14 @@ import snipdata
 import sender
 import html
 
+class PeerHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Handles every request in a thread of its own, so a slow search 
+       does not hold up the others. The threads share the command_handler
+       and its cache (see snipdata.SnipdexCache).
+    """
+    daemon_threads = True
+
+
 class PeerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Handles HTTP peer requests of the following form:
        http://127.0.0.1:8472/snipdex/xxx.yyy
@@ -46,6 +56,11 @@ class PeerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
          l= language (default is taken from http headers)
          f= format: must be one of ['html', 'xml'] (default is 'html')
          v= version: Snipdex version number (default = current_version)
+       http://127.0.0.1:8472/snipdex/?q=snipdexgoodtoseeyou&after={after}&since={since}&size={size}
+         (from the mother peer only, see PeerCommandHandler.get_all_peers)
+         after= pid of the last peer of the previous page
+         since= only peers updated after this time stamp (delta mode)
+         size=  number of peers per page (default is 10)
        http://127.0.0.1:8472/snipdex/pitch (HTTP POST)
          format to be decided
     """
@@ -75,7 +90,7 @@ class PeerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_header("Location", "/snipdex/")
             self.end_headers()
             return
-        query_text = param.normalized_text()
+        query_text = param.normalized().text
         if (local_path == "/snipdex/" or local_path == "/snipdex/index.html") and query_text != u'':
             if (query_text == snipdata.SNIPDEX_QUERY_PONG): 
                 # exchange greetings
@@ -123,11 +138,14 @@ class PeerCommandHandler(object):
     """Represents a search peer in the network.
     """
     __slots__ = ["my_pid", "my_updated", "local_ip", "local_port", "public_ip", "public_port",
-                 "mother_peer", "original_mother_address", "webroot", "cache", "fall_back_peer_list",
+                 "mother_peer", "original_mother_address", "webroot", "cache", "writer", "fall_back_peer_list",
+                 "refreshing", "refreshing_lock", "reporter", "near_duplicate_bits", "fusion",
                  "logger", "overlay", "result_template", 
                  "trademark", "motto", "logo", "button"]
 
-    def __init__(self, my_port, mother_ip, mother_port, webroot, cachefile, logger):
+    def __init__(self, my_port, mother_ip, mother_port, webroot, cachefile, logger, cache_durability='normal',
+                 fresh_seconds=snipdata.CACHE_FRESH_SECONDS, stale_seconds=snipdata.CACHE_STALE_SECONDS,
+                 cache_shards=1, statistics_interval=0, near_duplicate_bits=None, fusion=None):
         """Creates a new Search Peer.
 
         @param port The port used by this peer.
@@ -135,6 +153,13 @@ class PeerCommandHandler(object):
         @param mother_port The port to use to communicate with the Mother Peer.
         @param web_location Location of the web data.
         @param logger Logging object to be used.
+        @param cache_durability Durability of cache writes: 'off', 'normal' or 'full'.
+        @param fresh_seconds Cached results fetched this long ago at most are served without searching.
+        @param stale_seconds Cached results fetched at most this long ago are served, and refreshed in the background.
+        @param cache_shards Number of files the cache is split into, see snipdata.ShardedCache.
+        @param statistics_interval Seconds between two reports of cache statistics in the log, 0 for none.
+        @param near_duplicate_bits If given, results of peers that are near duplicates are merged, see snipdata.NearDuplicates.
+        @param fusion If given, results are ranked by score, see snipdata.SNIPPET_FUSIONS, otherwise round robin.
         """
         # defaults may be overridden after registration at mother
         self.trademark       = "SnipDex"
@@ -144,7 +169,22 @@ class PeerCommandHandler(object):
         self.local_port      = my_port
         self.webroot         = webroot
         self.logger          = logger
-        self.cache           = snipdata.SnipdexCache(cachefile, logger)
+        if cache_shards > 1:
+            self.cache       = snipdata.ShardedCache(cachefile, logger, cache_shards, cache_durability,
+                                                     fresh_seconds=fresh_seconds, stale_seconds=stale_seconds)
+        else:
+            self.cache       = snipdata.SnipdexCache(cachefile, logger, cache_durability, 
+                                                     fresh_seconds=fresh_seconds, stale_seconds=stale_seconds)
+        self.writer          = snipdata.CacheWriter(self.cache, logger)  # see search()
+        self.writer.start()
+        self.reporter        = None
+        if statistics_interval > 0:
+            self.reporter    = snipdata.StatisticsReporter(self.cache, logger, statistics_interval)
+            self.reporter.start()
+        self.refreshing      = set()   # normalized queries being refreshed, see refresh()
+        self.refreshing_lock = Lock()
+        self.near_duplicate_bits = near_duplicate_bits
+        self.fusion          = fusion
         self.my_pid          = self.cache.get_my_peer_id()
         self.overlay         = self.init_overlay(webroot)
         f = open(webroot + "/results.html", "r")
@@ -160,6 +200,14 @@ class PeerCommandHandler(object):
             self.logger.warning("Warning: Mother peer and peer are equal; in stand-alone mode.")
 
 
+    def close(self):
+        """Writes pending cache updates and closes the cache, call this before exiting"""
+        self.writer.stop()
+        if self.reporter:
+            self.reporter.stop()
+        self.cache.close()
+
+
     def ip_without_register(self):
         """Get ip and port by pinging snipdex.net
         """
@@ -335,6 +383,9 @@ class PeerCommandHandler(object):
            Only the mother peer will receive these, if the query SNIPDEX_QUERY_PONG
            is issued. This way, the mother knows the peer is availble for search.
            The peers can be used by the mother to initiate query-based sampling.
+           With 'after' (and 'since') the next page follows the last peer of the 
+           previous page, see SnipdexCache.get_peers_after(). With only 'since' 
+           the mother gets the peers that changed since its last visit.
         """
         public_ip = query['public_ip']
         (mother_ip, mother_port) = self.mother_peer.public_address.split(':',1)
@@ -342,12 +393,25 @@ class PeerCommandHandler(object):
             page = int(query['p'])
         except (KeyError, ValueError):
             page = 1
-        if public_ip == mother_ip and query.normalized_text() == snipdata.SNIPDEX_QUERY_PONG: # 2nd check is also done above (won't hurt here)
+        try:
+            size = int(query['size'])
+        except (KeyError, ValueError):
+            size = snipdata.CACHE_PAGE_SIZE
+        after = None
+        since = None
+        if 'after' in query:
+            after = urllib.unquote_plus(query['after'])
+        if 'since' in query:
+            since = urllib.unquote_plus(query['since'])
+        if public_ip == mother_ip and query.normalized().text == snipdata.SNIPDEX_QUERY_PONG: # 2nd check is also done above (won't hurt here)
             self.logger.debug("Contacted by Mother.")
-            (peer_list, snippet_list) = self.cache.get_all_peers_by_page(page)
+            if after is None and since is None:
+                (peer_list, snippet_list) = self.cache.get_all_peers_by_page(page)
+            else:
+                (peer_list, snippet_list) = self.cache.get_peers_after(after, size, since)
         else:
             (peer_list, snippet_list) = (snipdata.PeerList(), snipdata.SnippetList())        
-        if page <= 1:
+        if page <= 1 and after is None:
             peer_list = self.put_myself_first(peer_list)         
         return (peer_list, snippet_list)
 
@@ -363,88 +427,146 @@ class PeerCommandHandler(object):
         """
         self.logger.debug("Processing Query : " + repr(query))
 
-        # Try the local cache
-        (peer_list, snippet_list) = self.cache.response_by_query_full(query)
+        localhost = query['public_ip'] == '127.0.0.1'   # only do your very best for localhost :-)
+        freshness = None
+        if localhost:
+            (freshness, pids) = self.cache.freshness(query)
+            self.logger.debug("Cache: " + freshness + " results from " + str(len(pids)) + " peers.")
+
+        # Try the local cache, peers of expired results are contacted again
+        (peer_list, snippet_list) = self.cache.response_by_query_full(query, 'TODO' if freshness == 'expired' else None)
         self.logger.debug("Cache: " + str(len(peer_list)) + " peers, " + 
                      str(len(snippet_list)) + " results.")
 
-        if query['public_ip'] == '127.0.0.1':   # only do your very best for localhost :-)
-
-            if self.mother_peer:
-                peer_list.merge_single(self.mother_peer, 'TODO') # if mother already in as 'DONE' then this will change nothing.
-
-            for time_to_life in range(3): # time to life is 2
-                next_peer_list = snipdata.PeerList()
-                thread_list = []
-                for (the_peer, status, score) in peer_list:
-                    if status == 'TODO':  # only peers who's status is 'TODO' will be contacted
-                        try:
-                            peer_link = sender.PeerLink(the_peer.get_open_template(), self.logger)
-                        except ValueError as ex: 
-                            self.logger.warning('Warning: ' + repr(ex))
-                            next_peer_list.merge_single(the_peer, 'ERROR', score)
-                        else:
-                            altered_query = self.remove_query_hints(query, the_peer.query_hints)
-                            threaded_peer = PeerSearchThread(the_peer, peer_link, altered_query)
-                            thread_list.append(threaded_peer)
-                            threaded_peer.start()
-                    else:
-                        if status == 'ME': # someone else's 'ME', the real me is added below.
-                            status = 'DONE'
-                        next_peer_list.merge_single(the_peer, status, score)
-
-                start = time.time()
-                for thread in thread_list:
-                    while thread.status is None and time.time() - start < 4:   # block for 3 seconds max. on each hop
-                        pass
-                    if thread.status == 'ERROR':
-                        self.logger.debug("ERROR: " + thread.peer.pid)
-                        next_peer_list.merge_single(thread.peer, 'ERROR', None) # change 'TODO' to 'ERROR'
-                    elif thread.status is None or thread.status == 'TIMEOUT':
-                        self.logger.debug("TIMEOUT: " + thread.peer.pid)
-                        next_peer_list.merge_single(thread.peer, 'TIMEOUT', None)
-                    else:
-                        nr_of_peers = 0
-                        nr_of_snippets = 0
-                        if thread.peer_list: 
-                            next_peer_list.merge(thread.peer_list)
-                            nr_of_peers = len(thread.peer_list)
-                        if thread.snippet_list:
-                            thread.snippet_list.add_origin(thread.peer.pid)
-                            snippet_list.merge(thread.snippet_list)
-                            nr_of_snippets = len(thread.snippet_list)
-                        if thread.peer_list or thread.snippet_list:
-                            next_peer_list.merge_single(thread.peer, 'DONE')
-                            #self.cache.thumbs_up_for_peer(thread.peer)   maybe here gather statistics about peers?
-                        else:
-                            next_peer_list.merge_single(thread.peer, 'EMPTY', 0.1)  
-                        
-                        self.logger.debug("HTTP Response: " + thread.peer.pid + ", " 
-                                          + str(nr_of_peers) + " peers, " 
-                                          + str(nr_of_snippets) + " results, " 
-                                          + "#hops: " + str(time_to_life + 1) + ")")
-                        if thread.new_query:  # Did my ip number change?
-                            (public_ip, public_port, local_ip, local_port, peer_ip, 
-                                peer_port) = self.ips_from_query_param(thread.new_query) # Some of this code is also in register
-                            if public_ip and public_ip != self.public_ip:
-                                self.logger.debug("Your ip numbers changed from " + 
-                                                     str(self.public_ip) + " to " + str(public_ip))
-                                self.store_ips(public_ip, public_port, local_ip, local_port)
-
-                if self.fall_back_peer_list:    # add fall_back peers (or default peers)
-                    next_peer_list.merge(self.fall_back_peer_list)
-                peer_list = next_peer_list
-
-            self.cache.update_response_full(query, peer_list, snippet_list) 
+        if localhost:
+            if freshness == 'stale':    # serve them now, search for the next time
+                self.refresh(query)
+            elif freshness != 'fresh':  # expired or missing
+                peer_list = self.search_network(query, peer_list, snippet_list)
         else:
-            self.cache.update_response_backoff(query, peer_list) # we still might learn from new terms and term combinations 
+            self.writer.update_response_backoff(query, peer_list) # we still might learn from new terms and term combinations 
             if len(peer_list) < 1 and self.fall_back_peer_list:  # add fall_back peers (or default peers)
                 peer_list.merge(self.fall_back_peer_list)
+            (local_peer_list, local_snippet_list) = self.cache.search_snippets(query) # also for queries never seen
+            for snippet in local_snippet_list:
+                if not snippet.get_signature() in snippet_list.signatures:
+                    snippet_list.append(snippet)
+            peer_list.merge(local_peer_list)
 
         peer_list_new = self.put_myself_first(peer_list)         #  the real 'ME'
         return (peer_list_new, snippet_list)
 
 
+    def search_network(self, query, peer_list, snippet_list):
+        """Contacts the peers (for at most 3 hops) to get up-to-date search 
+           results, and queues them for the cache.
+
+           @param query         The query to process (http query parameters)
+           @param peer_list     The peers to start with, those with status 'TODO' are contacted
+           @param snippet_list  The results so far, the new results are merged into it
+           @return              The peer list with the status of each peer
+        """
+        if self.mother_peer:
+            peer_list.merge_single(self.mother_peer, 'TODO') # if mother already in as 'DONE' then this will change nothing.
+
+        for time_to_life in range(3): # time to life is 2
+            next_peer_list = snipdata.PeerList()
+            thread_list = []
+            scores = dict()  # pid -> score of the peers contacted, see snipdata.fusion_reliability()
+            for (the_peer, status, score) in peer_list:
+                if status == 'TODO':  # only peers who's status is 'TODO' will be contacted
+                    try:
+                        peer_link = sender.PeerLink(the_peer.get_open_template(), self.logger)
+                    except ValueError as ex: 
+                        self.logger.warning('Warning: ' + repr(ex))
+                        next_peer_list.merge_single(the_peer, 'ERROR', score)
+                    else:
+                        altered_query = self.remove_query_hints(query, the_peer.query_hints)
+                        threaded_peer = PeerSearchThread(the_peer, peer_link, altered_query)
+                        thread_list.append(threaded_peer)
+                        scores[the_peer.pid] = snipdata.score_value(score)
+                        threaded_peer.start()
+                else:
+                    if status == 'ME': # someone else's 'ME', the real me is added below.
+                        status = 'DONE'
+                    next_peer_list.merge_single(the_peer, status, score)
+
+            start = time.time()
+            responses = []  # merged at once, see SnippetList.merge_many() and fuse()
+            for thread in thread_list:
+                while thread.status is None and time.time() - start < 4:   # block for 3 seconds max. on each hop
+                    pass
+                if thread.status == 'ERROR':
+                    self.logger.debug("ERROR: " + thread.peer.pid)
+                    next_peer_list.merge_single(thread.peer, 'ERROR', None) # change 'TODO' to 'ERROR'
+                elif thread.status is None or thread.status == 'TIMEOUT':
+                    self.logger.debug("TIMEOUT: " + thread.peer.pid)
+                    next_peer_list.merge_single(thread.peer, 'TIMEOUT', None)
+                else:
+                    nr_of_peers = 0
+                    nr_of_snippets = 0
+                    if thread.peer_list: 
+                        next_peer_list.merge(thread.peer_list)
+                        nr_of_peers = len(thread.peer_list)
+                    if thread.snippet_list:
+                        thread.snippet_list.add_origin(thread.peer.pid, None, scores[thread.peer.pid])
+                        responses.append(thread.snippet_list)
+                        nr_of_snippets = len(thread.snippet_list)
+                    if thread.peer_list or thread.snippet_list:
+                        next_peer_list.merge_single(thread.peer, 'DONE')
+                        #self.cache.thumbs_up_for_peer(thread.peer)   maybe here gather statistics about peers?
+                    else:
+                        next_peer_list.merge_single(thread.peer, 'EMPTY', 0.1)  
+                    
+                    self.logger.debug("HTTP Response: " + thread.peer.pid + ", " 
+                                      + str(nr_of_peers) + " peers, " 
+                                      + str(nr_of_snippets) + " results, " 
+                                      + "#hops: " + str(time_to_life + 1) + ")")
+                    if thread.new_query:  # Did my ip number change?
+                        (public_ip, public_port, local_ip, local_port, peer_ip, 
+                            peer_port) = self.ips_from_query_param(thread.new_query) # Some of this code is also in register
+                        if public_ip and public_ip != self.public_ip:
+                            self.logger.debug("Your ip numbers changed from " + 
+                                                 str(self.public_ip) + " to " + str(public_ip))
+                            self.store_ips(public_ip, public_port, local_ip, local_port)
+
+            if responses:
+                if self.fusion:
+                    snippet_list.fuse(responses, self.fusion, near_duplicate_bits=self.near_duplicate_bits)
+                else:
+                    snippet_list.merge_many(responses, self.near_duplicate_bits)
+            if self.fall_back_peer_list:    # add fall_back peers (or default peers)
+                next_peer_list.merge(self.fall_back_peer_list)
+            peer_list = next_peer_list
+
+        self.writer.update_response_full(query, peer_list, snippet_list) # do not wait for the cache
+        return peer_list
+
+
+    def refresh(self, query):
+        """Runs search_network() in the background for stale cached results, 
+           contacting the peers of the cached results again. Only one refresh 
+           per query runs at a time.
+        """
+        query_text = query.normalized().text
+        with self.refreshing_lock:
+            if query_text in self.refreshing:
+                return
+            self.refreshing.add(query_text)
+        def run():
+            try:
+                (peer_list, snippet_list) = self.cache.response_by_query_full(query, 'TODO')
+                self.search_network(query, peer_list, snippet_list)
+            except Exception as ex:
+                self.logger.warning("Warning: Refresh of '" + query_text + "' failed: " + repr(ex))
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(query_text)
+        thread = Thread(target=run, name="refresh " + query_text)
+        thread.daemon = True
+        thread.start()
+
+
     def remove_query_hints(self, query, query_hints):
         altered_query = snipdata.Query()
         for key in query:
@@ -532,7 +654,7 @@ if (__name__ == '__main__'):
     PeerRequestHandler.command_handler = command_handler
 
     logger.debug("Testing at: http://localhost:" + str(my_port) + "/snipdex/")
-    server = BaseHTTPServer.HTTPServer(('', my_port), PeerRequestHandler)
+    server = PeerHTTPServer(('', my_port), PeerRequestHandler)
     server.serve_forever()
 
 
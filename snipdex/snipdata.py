@@ -23,12 +23,23 @@ Authors: Almer Tigelaar
          Djoerd Hiemstra 
 """
 
+import sys
 import urllib
 import hashlib
 import sqlite3
+import marshal
+import struct
+import math
+import zlib
+import time
 import datetime
 import random
 import re
+import heapq
+from contextlib import contextmanager
+from functools import wraps
+from collections import OrderedDict, deque
+from threading import Thread, Event, Condition, Lock, RLock, current_thread
 from operator import itemgetter
 from xml.sax import saxutils # For escaping xml output
 
@@ -38,12 +49,80 @@ import html
 SNIPPET_MAX_TITLE_LENGTH        = 256
 SNIPPET_MAX_SUMMARY_LENGTH      = 512 
 SNIPPET_MAX_EXT_SUMMARY_LENGTH  = 2048
+SNIPPET_PAGE_SIZE               = 10      # results per page of html.basic_render()
+SNIPPET_MAX_PAGES               = 10      # and pages at most
+SNIPPET_MAX_RESULTS             = SNIPPET_PAGE_SIZE * SNIPPET_MAX_PAGES  # kept by SnippetList.fuse()
+SNIPPET_RRF_K                   = 60      # rank offset of Reciprocal Rank Fusion (see fusion_rrf())
 SNIPDEX_RESPONSE_VERSION        = "0.2"
+SNIPDEX_CACHE_VERSION           = 10      # stored as 'pragma user_version' in the cache file
+
+CACHE_CODEC_VERSION   = '\x01'  # first byte of every encoded cache value
+CACHE_CODEC_DEFLATE   = '\x02'  # first byte of a compressed snippet, see SnippetCodec
+CACHE_MARSHAL_VERSION = 2       # marshal format, readable by all Python 2.5+ versions
+CACHE_EMPTY_SID       = 0       # snippet id of the origins-only snippet of a query
+CACHE_MAX_VARIABLES   = 500     # maximum number of '?' in one statement (sqlite allows 999)
+
+# sqlite 'synchronous' setting for each durability level of the cache:
+#   off:    no fsync at all, a crash of the OS may corrupt the cache
+#   normal: fsync on WAL checkpoints only, a crash may lose the last searches
+#   full:   fsync on every commit
+CACHE_DURABILITY = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}
+
+CACHE_HOT_QUERIES = 1000              # maximum number of decoded responses kept in memory
+CACHE_HOT_BYTES   = 16 * 1024 * 1024  # maximum (encoded) size of the decoded responses in memory
+CACHE_HOT_PEERS   = 10000             # maximum number of peers kept in memory (see PeerDirectory)
+CACHE_PEER_FLUSH  = 60                # seconds between two writes of the updated times of unchanged peers
+
+CACHE_DICTIONARY_SIZE    = 32 * 1024 - 262  # shared dictionary size, what deflate can refer back to
+CACHE_DICTIONARY_SAMPLES = 1000             # snippets needed to train a dictionary
+
+CACHE_BLOOM_BITS   = 10  # bits per cached query in the BloomFilter, 
+CACHE_BLOOM_HASHES = 7   # and bit positions per query: about 1% false positives
+
+# Freshness of a cached response (see SnipdexCache.freshness()): fresh ones
+# are served from the cache, stale ones as well while they are refreshed 
+# in the background, older ones are expired and fetched again.
+CACHE_FRESH_SECONDS = 3600        # fetched this long ago at most, a response is fresh
+CACHE_STALE_SECONDS = 7 * 86400   # and at most this long ago, it is stale
+
+# Upper bounds (seconds) of the latency histograms of CacheMetrics,
+# the last bucket counts the slower operations
+CACHE_LATENCY_BUCKETS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0)
+
+CACHE_SEARCH_RESULTS = 10  # snippets returned by search_snippets(), by default
+
+CACHE_PAGE_SIZE     = 10   # peers per page of get_peers_after(), by default
+CACHE_MAX_PAGE_SIZE = 100  # and at most
+
+# Peer attributes that many peers share (the same template, mimetype, XPath 
+# queries), these are interned when a peer is read from the cache.
+CACHE_INTERNED_PEER_ATTRIBUTES = ("language", "hashtag", "open_template", "html_template", "suggest_template")
+
+CACHE_MAX_QUERIES      = 100000             # maximum number of queries (and terms) in the cache file
+CACHE_MAX_BYTES        = 256 * 1024 * 1024  # maximum size of the cache file
+CACHE_TTL_DAYS         = 180                # snippets and peers not seen for this long are removed
+CACHE_COMPACT_INTERVAL = 600                # seconds between two compactions
+CACHE_EVICT_BATCH      = 100                # queries evicted per transaction
+CACHE_VACUUM_PAGES     = 64                 # pages returned to the file system per step
 
 SNIPDEX_QUERY_REGISTER = 'snipdexiamback'
 SNIPDEX_QUERY_PONG     = 'snipdexgoodtoseeyou'
 SNIPDEX_QUERY_MYSELF   = 'snipdexwhoami'
 
+# Rules of canonical_url(), urls of the same page get the same snippet signature
+URL_PARTS         = re.compile(r"^([A-Za-z][A-Za-z0-9+.-]*)://([^/?#]*)([^?#]*)(\?[^#]*)?(#.*)?$")
+URL_WWW           = re.compile(r"^www[0-9]*\.")
+URL_DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+URL_INDEX_PAGE    = re.compile(r"/(?:index|default)\.(?:html?|php|aspx?|jsp)$", re.IGNORECASE)
+URL_TRACKING      = re.compile(r"^(?:utm_[a-z]+|gclid|dclid|fbclid|msclkid|yclid|mc_cid|mc_eid|_ga|_hsenc|_hsmi)(?:=|$)", 
+                               re.IGNORECASE)
+
+# Near duplicate snippets (see simhash() and NearDuplicates)
+SNIPPET_NEAR_DUPLICATE_BITS = 3   # SimHashes of near duplicates differ in this many bits at most, by default
+SIMHASH_WORDS     = re.compile(r"\w+", re.UNICODE)
+SIMHASH_MIN_WORDS = 10            # shorter titles and summaries are not compared
+SIMHASH_HASH      = struct.Struct("<Q")  # 64 bits of the md5 of a shingle
+
 #
 # Some general tools first
 #
@@ -128,6 +207,389 @@ def snipdex_response(query, peer_list, snippet_list):
     return result 
 
 
+#
+#  Binary cache encoding
+#
+#  Cached values are a version byte followed by a marshalled plain
+#  tuple of the object's attributes, in constructor argument order.
+#
+
+def encode_snippet(snippet):
+    """Encodes a Snippet, without its origins, for storage in the cache
+       @snippet  Snippet()
+       @return   binary string
+    """
+    s = snippet
+    row = (s.location, s.title, s.found, s.summary, s.extended_summary,
+           s.preview, s.geolocation, s.direct_links, s.service_links, s.attributes)
+    return CACHE_CODEC_VERSION + marshal.dumps(row, CACHE_MARSHAL_VERSION)
+
+
+def decode_snippet(data, origins):
+    """Decodes a Snippet stored by encode_snippet()
+       @data     binary string (or sqlite buffer)
+       @origins  list of tuples (pid, status, score)
+       @return   Snippet()
+    """
+    data = str(data)
+    if data[:1] != CACHE_CODEC_VERSION:
+        raise ValueError('Unknown cache encoding: ' + repr(data[:1]))
+    return Snippet(origins, *marshal.loads(data[1:]))
+
+
+def decode_snippet_list(data):
+    """Decodes a whole SnippetList, as stored by cache version 1
+       @data    binary string (or sqlite buffer)
+       @return  SnippetList()
+    """
+    data = str(data)
+    if data[:1] != CACHE_CODEC_VERSION:
+        raise ValueError('Unknown cache encoding: ' + repr(data[:1]))
+    return SnippetList(*[Snippet(*row) for row in marshal.loads(data[1:])])
+
+
+def encode_peer(peer):
+    """Encodes a Peer for storage in the cache
+       @peer    Peer()
+       @return  binary string
+    """
+    row = tuple(getattr(peer, attribute) for attribute in Peer.__slots__)
+    return CACHE_CODEC_VERSION + marshal.dumps(row, CACHE_MARSHAL_VERSION)
+
+
+def decode_peer(data):
+    """Decodes a Peer stored by encode_peer()
+       @data    binary string (or sqlite buffer)
+       @return  Peer()
+    """
+    data = str(data)
+    if data[:1] != CACHE_CODEC_VERSION:
+        raise ValueError('Unknown cache encoding: ' + repr(data[:1]))
+    peer = Peer(*marshal.loads(data[1:]))
+    for name in CACHE_INTERNED_PEER_ATTRIBUTES:
+        setattr(peer, name, intern_strings(getattr(peer, name)))
+    return peer
+
+
+def intern_strings(value):
+    """Interns (byte) strings, also inside tuples and lists, so equal 
+       strings of different peers share memory
+    """
+    if type(value) is str:
+        return intern(value)
+    elif type(value) is tuple or type(value) is list:
+        return type(value)(intern_strings(item) for item in value)
+    else:
+        return value
+
+
+def encode_bloom_filter(bloom):
+    """Encodes a BloomFilter for storage in the cache
+       @bloom   BloomFilter()
+       @return  binary string
+    """
+    row = (bloom.capacity, bloom.hashes, bloom.count, str(bloom.bits))
+    return CACHE_CODEC_VERSION + marshal.dumps(row, CACHE_MARSHAL_VERSION)
+
+
+def decode_bloom_filter(data):
+    """Decodes a BloomFilter stored by encode_bloom_filter()
+       @data    binary string (or sqlite buffer)
+       @return  BloomFilter()
+    """
+    data = str(data)
+    if data[:1] != CACHE_CODEC_VERSION:
+        raise ValueError('Unknown cache encoding: ' + repr(data[:1]))
+    (capacity, hashes, count, bits) = marshal.loads(data[1:])
+    bloom = BloomFilter(capacity, hashes)
+    if len(bits) != len(bloom.bits):
+        raise ValueError('Bloom filter does not match its capacity')
+    bloom.bits = bytearray(bits)
+    bloom.count = count
+    return bloom
+
+
+def canonical_url(location):
+    """Returns the canonical form of an absolute url: lower case scheme and
+       host, without 'www.', default port, default index page, trailing 
+       slash and tracking parameters (see URL_TRACKING)
+       @location  absolute url
+       @return    canonical url
+    """
+    match = URL_PARTS.match(location)
+    if match is None:
+        return location
+    (scheme, host, path, query, fragment) = match.groups()
+    scheme = scheme.lower()
+    host = URL_WWW.sub("", host.lower())
+    port = URL_DEFAULT_PORTS.get(scheme)
+    if port and host.endswith(port):
+        host = host[:-len(port)]
+    path = URL_INDEX_PAGE.sub("/", path).rstrip("/")
+    if query:
+        parameters = [parameter for parameter in query[1:].split("&") 
+                      if parameter and not URL_TRACKING.match(parameter)]
+        query = "?" + "&".join(parameters) if parameters else ""
+    return scheme + "://" + host + path + (query or "") + (fragment or "")
+
+
+def simhash(text):
+    """Returns the 64 bit SimHash of the word 3-shingles of a text: texts 
+       that share most shingles have SimHashes that differ in a few bits.
+       Bit i of the SimHash is set if more than half of the shingle hashes 
+       have bit i set. The 64 counts are bit sliced: counters[k] holds bit 
+       k of each count, so a hash is added with a few 64 bit operations.
+       @text    unicode or utf-8 string
+       @return  integer, or None if the text has less than SIMHASH_MIN_WORDS words
+    """
+    words = SIMHASH_WORDS.findall(text.lower())
+    if len(words) < SIMHASH_MIN_WORDS:
+        return None
+    shingles = set(" ".join(words[i:i + 3]) for i in range(len(words) - 2))
+    counters = []
+    for shingle in shingles:
+        if isinstance(shingle, unicode):
+            shingle = shingle.encode('utf-8')
+        carry = SIMHASH_HASH.unpack_from(hashlib.md5(shingle).digest())[0]
+        k = 0
+        for counter in counters:  # ripple carry adder
+            counters[k] = counter ^ carry
+            carry &= counter
+            if not carry:
+                break
+            k += 1
+        else:
+            counters.append(carry)
+    half = len(shingles) // 2
+    greater = 0                   # counts > half, compared from the highest bit down
+    equal = (1 << 64) - 1
+    for k in reversed(range(max(len(counters), half.bit_length()))):
+        counter = counters[k] if k < len(counters) else 0
+        if (half >> k) & 1:
+            equal &= counter
+        else:
+            greater |= equal & counter
+            equal &= ~counter
+    return greater
+
+
+def score_value(score, default=1.0):
+    """Returns a score as a float: scores of peers parsed from responses 
+       are unicode strings, unknown scores are None
+       @score    float, integer, string or None
+       @default  the value of a score that is not a number
+    """
+    try:
+        return float(score)
+    except (ValueError, TypeError):
+        return default
+
+
+def fusion_rrf(rank, length, snippet):
+    """Reciprocal Rank Fusion: 1 / (k + rank), see SnippetList.fuse()
+       @rank     rank of snippet in its list, from 0
+       @length   length of the list
+       @snippet  Snippet()
+       @return   score of snippet for this list
+    """
+    return 1.0 / (SNIPPET_RRF_K + rank + 1)
+
+
+def fusion_combsum(rank, length, snippet):
+    """CombSUM of scores normalized by rank: from 1 for the first snippet 
+       of a list down to 1 / length for the last one (see fusion_rrf())"""
+    return 1.0 - float(rank) / length
+
+
+def fusion_reliability(rank, length, snippet):
+    """Reciprocal Rank Fusion, weighted by the reliability of the peers
+       the snippet came from: one plus the best score of its origins"""
+    reliability = max([score_value(score, 0.0) for (pid, status, score) in snippet.origins] or [0.0])
+    return (1.0 + reliability) / (SNIPPET_RRF_K + rank + 1)
+
+
+SNIPPET_FUSIONS = {'rrf': fusion_rrf, 'combsum': fusion_combsum, 'reliability': fusion_reliability}
+
+
+def signature_key(signature):
+    """Returns the key under which the cache stores snippets with this signature"""
+    if isinstance(signature, unicode):
+        signature = signature.encode('utf-8')
+    return hashlib.md5(signature).digest()
+
+
+def backoff_terms(parts):
+    """Returns the terms under which SnipdexCache.update_response_backoff() 
+       stores the peers of a query: the single terms, the prefixes, and the 
+       full query. Each appears only once.
+       @parts   the terms of a normalized query
+       @return  list of normalized queries
+    """
+    terms = list(parts) + ["+".join(parts[:i]) for i in range(2, len(parts) + 1)]
+    seen = set()
+    return [term for term in terms if not (term in seen or seen.add(term))]
+
+
+def sub_queries(parts):
+    """Returns the sub-queries of a query that SnipdexCache.response_by_query_full() 
+       looks up: the first term, the sub-queries of the remaining terms, the
+       prefixes, and finally the full query itself. Each appears only once.
+       @parts   the terms of a normalized query
+       @return  list of normalized queries
+    """
+    if len(parts) <= 1:
+        return ["+".join(parts)]
+    terms = [parts[0]] + sub_queries(parts[1:]) + ["+".join(parts[:i]) for i in range(2, len(parts) + 1)]
+    seen = set()
+    return [term for term in terms if not (term in seen or seen.add(term))]
+
+
+def backoff_pids(updates):
+    """Returns the peers to store in the term_peers index for several 
+       responses: the pids for each of their backoff_terms(), and all peers.
+       @updates  list of (query, peer_list)
+       @return   (OrderedDict term -> list of pids, list of peers)
+    """
+    pids_by_term = OrderedDict()
+    peers = list()
+    for (query, peer_list) in updates:
+        peers.extend(peer_list)
+        for term in backoff_terms(query.normalized().terms):
+            pids = pids_by_term.setdefault(term, [])
+            for (peer, status, score) in peer_list:
+                if not peer.pid in pids:
+                    pids.append(peer.pid)
+    return (pids_by_term, peers)
+
+
+def shard_number(query_text, shards):
+    """Returns the shard (0 to shards - 1) of a normalized query or term, 
+       see ShardedCache"""
+    if isinstance(query_text, unicode):
+        query_text = query_text.encode('utf-8')
+    return struct.unpack("<Q", hashlib.md5(query_text).digest()[:8])[0] % shards
+
+
+def shard_filename(filename, number):
+    """Returns the file name of a shard of the cache in filename"""
+    return filename + "-shard" + str(number)
+
+
+def in_parallel(calls):
+    """Runs each call in its own thread, and returns their results. If 
+       a call raises an exception, the (first) exception is raised again.
+       @calls   list of (function, arguments)
+       @return  list of results, in the order of calls
+    """
+    if len(calls) == 1:
+        (function, arguments) = calls[0]
+        return [function(*arguments)]
+    results = [None] * len(calls)
+    errors = list()
+    def run(i, function, arguments):
+        try:
+            results[i] = function(*arguments)
+        except:
+            errors.append(sys.exc_info())
+    threads = [Thread(target=run, args=(i, function, arguments)) for (i, (function, arguments)) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        (kind, value, traceback) = errors[0]
+        raise kind, value, traceback
+    return results
+
+
+def timed(method):
+    """Decorates a cache operation: its latency is recorded in the metrics 
+       of the cache, see CacheMetrics"""
+    name = method.__name__
+    @wraps(method)
+    def timed_method(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.metrics.observe(name, time.time() - start)
+    return timed_method
+
+
+def split_cache(filename, logger, shards):
+    """Splits the cache in filename into shards (see ShardedCache): the 
+       snippets, term peers and queries move to the shard of their query, 
+       the peers and the peer's own queries stay. Snippets keep their ids.
+       Does nothing if the cache was already split into this many shards.
+       Each shard is filled anew and recorded in the meta 'split', so a 
+       split that was interrupted is finished by the next call.
+       @filename  the (main) cache file
+       @shards    number of shard files
+    """
+    main = SnipdexCache(filename, logger, compact_interval=0, shards=None)
+    try:
+        with main.transaction() as c:
+            c.execute("select name, value from meta where name in ('shards', 'splitting', 'split')")
+            meta = dict((name, int(value)) for (name, value) in c.fetchall())
+            if meta.get('splitting', shards) != shards:
+                raise ValueError("Cache is being split into " + str(meta['splitting']) + " shards, not " + 
+                                 str(shards) + ": " + filename)
+            if 'shards' not in meta:
+                c.execute("insert or replace into meta values ('splitting', ?)", (shards, ))
+        if 'shards' in meta:
+            if meta['shards'] != shards:
+                raise ValueError("Cache is split into " + str(meta['shards']) + " shards, not " + str(shards) + ": " + filename)
+            for number in range(shards):  # lost shards start empty
+                SnipdexCache(shard_filename(filename, number), logger, compact_interval=0, peer_cache=main).close()
+            return
+        logger.warning("Splitting cache into " + str(shards) + " shards: " + filename)
+        own = (SNIPDEX_QUERY_MYSELF, SNIPDEX_QUERY_REGISTER)  # stay with the peers
+        main.cache.create_function("snipdex_shard", 1, lambda query_text: shard_number(query_text, shards))
+        c = main.cache.cursor()
+        for number in range(meta.get('split', 0), shards):
+            shard = SnipdexCache(shard_filename(filename, number), logger, compact_interval=0, peer_cache=main)
+            searchable = shard.searchable
+            shard.close()
+            c.execute("attach database ? as shard", (shard_filename(filename, number), ))
+            with main.transaction():
+                for table in ('postings', 'origins', 'snippet_store', 'term_peers', 'queries'):
+                    c.execute("delete from shard." + table)  # left by an interrupted split
+                if searchable:
+                    c.execute("delete from shard.snippet_text")
+                where = " not in (?,?) and snipdex_shard(%s)=?"
+                c.execute("insert into shard.postings select * from postings where query" + where % "query", 
+                          own + (number, ))
+                c.execute("insert into shard.origins select * from origins where query" + where % "query", 
+                          own + (number, ))
+                c.execute("insert into shard.snippet_store select * from snippet_store where sid in "
+                          "(select sid from shard.postings)")
+                if main.searchable and searchable:
+                    c.execute("insert into shard.snippet_text (rowid, title, summary) select rowid, title, summary "
+                              "from snippet_text where rowid in (select sid from shard.snippet_store)")
+                c.execute("insert into shard.term_peers select * from term_peers where term" + where % "term", 
+                          own + (number, ))
+                c.execute("insert into shard.queries select * from queries where query" + where % "query",
+                          own + (number, ))
+                c.execute("insert or replace into shard.meta select * from meta where name like 'dictionary:%'")
+                c.execute("delete from shard.meta where name='bloom'")  # rebuilt on open
+                c.execute("insert or replace into meta values ('split', ?)", (number + 1, ))
+            c.execute("detach database shard")
+        with main.transaction():
+            c.execute("delete from postings where query not in (?,?)", own)
+            c.execute("delete from origins where query not in (?,?)", own)
+            c.execute("delete from term_peers where term not in (?,?)", own)
+            c.execute("delete from queries where query not in (?,?)", own)
+            if main.searchable:
+                c.execute("delete from snippet_text where rowid not in (select sid from postings)")
+            c.execute("delete from snippet_store where sid not in (select sid from postings)")
+            c.execute("delete from meta where name in ('splitting', 'split')")
+            c.execute("insert or replace into meta values ('shards', ?)", (shards, ))
+            main._rebuild_bloom_filter(c)
+            main.hot.clear()
+        c.close()
+    finally:
+        main.close()
+
 #
 # Classes
 #
@@ -137,37 +599,493 @@ class SnipdexCache(object):
     """Caches peers and snippets. 
     """
 
-    __slots__ = [ "cache", "logger", "known_peers"]
-
-    def __init__(self, filename, logger):
+    __slots__ = [ "cache", "filename", "logger", "known_peers", "depth", "hot", 
+                  "accessed", "evicted", "compactor", "lock", "owner", "readers",
+                  "bloom", "max_queries", "skipped", "searchable", "codec",
+                  "fresh_seconds", "stale_seconds", "peer_cache", "metrics", "changes", "access_lock"]
+
+    def __init__(self, filename, logger, durability='normal',
+                 hot_queries=CACHE_HOT_QUERIES, hot_bytes=CACHE_HOT_BYTES,
+                 max_queries=CACHE_MAX_QUERIES, max_bytes=CACHE_MAX_BYTES, ttl_days=CACHE_TTL_DAYS,
+                 compact_interval=CACHE_COMPACT_INTERVAL, hot_peers=CACHE_HOT_PEERS,
+                 fresh_seconds=CACHE_FRESH_SECONDS, stale_seconds=CACHE_STALE_SECONDS,
+                 peer_cache=None, shards=1):
         """Creates the Snipdex cache
-           snippets: two column table with (query, snippet_list) 
-                      query with '#' are like vertical '#video' (inspired by Blekko, Twitter)?
-                      query with '$' are languages '$nl'?
-           peers:     two column table with (pid, peer)
-                      (to be kept in memory also)
-
-           @file  filename for cache
+           snippet_store: (sid, signature, snippet, found, stored) every snippet stored 
+                          once, by the md5 of its signature (see signature_key()), 
+                          stored is when the cache last stored the snippet
+           postings:      (query, rank, sid) the ranked snippets of a query
+                          query with '#' are like vertical '#video' (inspired by Blekko, Twitter)?
+                          query with '$' are languages '$nl'?
+           origins:       (query, sid, pid, status, score) the origins of a snippet 
+                          for a query, sid 0 collects the peers without snippets.
+           term_peers:    (term, pid) the peers that answered queries containing 
+                          term, where term is a single term, a query prefix or a 
+                          full query (see update_response_backoff())
+           queries:       (query, accessed, fetched, fetched_from) when a query 
+                          or term was last used, and when its full response was
+                          last fetched from the network and from which peers
+           snippet_text:  (title, summary) full text index of the snippet store,
+                          with the sid as rowid (see search_snippets())
+           meta:          (name, value) other things, such as the bloom filter
+                          and the dictionaries of the SnippetCodec
+           peers:         three column table with (pid, peer, updated)
+                          (read when needed, see PeerDirectory)
+           Values are stored in the binary format of encode_snippet()
+           and encode_peer().
+           The cache runs in WAL mode, writes are grouped by transaction().
+           All statements use fixed SQL text with parameters, so the sqlite3
+           statement cache keeps them prepared.
+           Recently used snippet lists are kept decoded in memory (see LRUCache).
+           Lookups of queries that were never cached do not go to disk (see 
+           BloomFilter), the filter is kept in the meta table on close().
+           A CacheCompactor thread keeps the cache file within its limits.
+           The cache may be shared by threads (see CacheWriter, PeerHTTPServer):
+           writes are serialized by a lock on a single connection, reads 
+           use a pool of connections and do not wait (see reading()).
+
+           @file             filename for cache
+           @durability       one of CACHE_DURABILITY: 'off', 'normal' or 'full'
+           @hot_queries      maximum number of queries kept decoded in memory
+           @hot_bytes        maximum encoded size of the queries kept in memory
+           @max_queries      maximum number of queries and terms in the cache file
+           @max_bytes        maximum size of the cache file
+           @ttl_days         snippets stored and peers updated longer ago are removed
+           @compact_interval seconds between compactions, 0 disables the compactor
+           @hot_peers        maximum number of peers kept in memory
+           @fresh_seconds    responses fetched this long ago at most are fresh
+           @stale_seconds    and at most this long ago stale (see freshness())
+           @peer_cache       the SnipdexCache that stores the peers, if not this
+                             one (a shard of a ShardedCache)
+           @shards           the number of shards the file is the main file of,
+                             a file that was split otherwise is refused, None
+                             opens it anyway (see split_cache())
         """
-        self.cache       = sqlite3.connect(filename)
+        if durability not in CACHE_DURABILITY:
+            raise ValueError("Unknown cache durability: " + repr(durability))
+        self.cache       = sqlite3.connect(filename, isolation_level=None,  # see transaction()
+                                           check_same_thread=False)   # the writer's connection
+        self.filename    = filename
         self.logger      = logger
-        self.known_peers = dict()
+        self.peer_cache  = peer_cache or self
+        self.known_peers = PeerDirectory(self, hot_peers) if peer_cache is None else peer_cache.known_peers
+        self.depth       = 0       # nesting depth of transaction()
+        self.hot         = LRUCache(hot_queries, hot_bytes)
+        self.accessed    = dict()  # query -> last access, not yet in the queries table
+        self.access_lock = Lock()  # taken for accessed and skipped, see _touch()
+        self.evicted     = deque() # ('query', query) and ('peer', pid) removed by the compactor
+        self.compactor   = None
+        self.lock        = RLock() # taken by transaction()
+        self.owner       = None    # the thread inside transaction()
+        self.readers     = deque() # the pool of read connections, see reading()
+        self.max_queries = max_queries
+        self.bloom       = BloomFilter(max_queries)  # the cached queries and terms
+        self.skipped     = 0       # lookups the bloom filter saved
+        self.searchable  = False   # sqlite has FTS5, see _create_snippet_text()
+        self.codec       = SnippetCodec()
+        self.fresh_seconds = fresh_seconds
+        self.stale_seconds = stale_seconds
+        self.metrics     = CacheMetrics()  # see statistics()
+        self.changes     = 0       # total_changes of the connection when transaction() began
         c = self.cache.cursor()
+        c.execute("pragma auto_vacuum = incremental")  # only has effect on a new file
+        c.execute("pragma journal_mode = wal")
+        c.execute("pragma synchronous = " + CACHE_DURABILITY[durability])
         try:
-            c.execute("select * from peers")
+            c.execute("select pid from peers limit 1").fetchall()
         except sqlite3.OperationalError:
             self.logger.warning("Creating new cache at: " + filename)
-            c.execute("create table peers (pid text primary key, peer text)")  # TODO: primary keys?
-            c.execute("create table snippets (query text primary key, response text)")
-            self.cache.commit()
-            pid = new_random_id()          
-            self.insert_response(Query({'q': SNIPDEX_QUERY_MYSELF}), PeerList(Peer(pid=pid)), SnippetList())
+            c.execute("create table peers (pid text primary key, peer text, updated text)")
+            c.execute("create index peers_updated on peers (updated, pid)")
+            self._create_snippet_tables(c)
+            c.execute("pragma user_version = %d" % SNIPDEX_CACHE_VERSION)
+            if peer_cache is None:
+                pid = new_random_id()
+                self.insert_response(Query({'q': SNIPDEX_QUERY_MYSELF}), PeerList(Peer(pid=pid)), SnippetList())
         else:
-            for row in c:       # load all peers in memory
-                peer = eval(row[1])
-                self.known_peers[peer.pid] = peer
-            self.logger.debug("Open cache: " + filename + " (" + str(len(self.known_peers)) + " peers)")
+            c.execute("select count(*) from sqlite_master where name='snippet_text'")
+            self.searchable = c.fetchone()[0] > 0
+            self._migrate(filename)
+            self._load_bloom_filter()
+            self._load_dictionaries()
+            self.logger.debug("Open cache: " + filename)
+        c.close()
+        if shards is not None:
+            self._check_shards(filename, shards)
+        if compact_interval > 0:
+            self.compactor = CacheCompactor(filename, logger, self.evicted, compact_interval,
+                                            max_queries, max_bytes, ttl_days)
+            self.compactor.start()
+
+
+    def _check_shards(self, filename, shards):
+        """Raises ValueError if the file is not the main file of the given 
+           number of shards: opened as a single file, the main file of a 
+           ShardedCache would look empty.
+        """
+        c = self.cache.cursor()
+        c.execute("select value from meta where name='shards'")
+        row = c.fetchone()
         c.close()
+        split = int(row[0]) if row else 1
+        if split != shards:
+            self.cache.close()
+            if split > 1:
+                raise ValueError("Cache is split into " + str(split) + " shards, not " + 
+                                 str(shards) + ": " + filename)
+            raise ValueError("Cache is not split into " + str(shards) + " shards: " + filename)
+
+
+    def _create_snippet_tables(self, c):
+        c.execute("create table snippet_store (sid integer primary key, signature blob unique, snippet blob, "
+                  "found text, stored text)")
+        c.execute("create index snippet_store_stored on snippet_store (stored)")
+        self._create_snippet_text(c)
+        c.execute("create table postings (query text, rank integer, sid integer, primary key (query, rank))")
+        c.execute("create index postings_sid on postings (sid)")
+        c.execute("create table origins (query text, sid integer, pid text, status text, score, "
+                  "primary key (query, sid, pid))")
+        c.execute("create index origins_pid on origins (pid)")
+        c.execute("create index origins_sid on origins (sid)")
+        c.execute("create table term_peers (term text, pid text, primary key (term, pid))")
+        c.execute("create index term_peers_pid on term_peers (pid)")
+        c.execute("create table queries (query text primary key, accessed text, fetched text, fetched_from text)")
+        c.execute("create index queries_accessed on queries (accessed)")
+        c.execute("create table meta (name text primary key, value blob)")
+
+
+    def _create_snippet_text(self, c):
+        """Creates the full text index, if sqlite has FTS5. Without it,
+           search_snippets() finds nothing.
+        """
+        try:
+            c.execute("create virtual table snippet_text using fts5 (title, summary)")
+        except sqlite3.OperationalError as ex:
+            self.logger.warning("Warning: No full text search of cached snippets: " + repr(ex))
+        else:
+            self.searchable = True
+
+
+    def _migrate(self, filename):
+        """Converts a cache file written by an older Snipdex version.
+           Version 0 stored the Python repr() of peers and snippet lists,
+           these are evaluated one last time and re-encoded.
+           Version 1 stored a whole snippet list per query in the 'snippets' 
+           table, these are split into the snippet store and postings.
+           Version 2 had no term_peers, it is filled from the origins.
+           Version 3 had no access times, found and updated columns, and no
+           incremental vacuum.
+           Version 4 indexed peers on updated only.
+           Version 5 had no meta table.
+           Version 6 had no full text index (snippet_text).
+           Version 7 had no freshness (fetched, fetched_from) of queries.
+           Version 8 keyed the snippet store by signatures without 
+           canonical_url().
+           Version 9 expired snippets on the found time given by peers, 
+           instead of the time they were stored (stored).
+        """
+        c = self.cache.cursor()
+        c.execute("pragma user_version")
+        version = c.fetchone()[0]
+        if version > SNIPDEX_CACHE_VERSION:
+            raise ValueError("Cache was written by a newer Snipdex version: " + filename)
+        if version == SNIPDEX_CACHE_VERSION:
+            c.close()
+            return
+        self.logger.warning("Converting cache to version " + str(SNIPDEX_CACHE_VERSION) + ": " + filename)
+        with self.transaction():
+            if version < 1:
+                c.execute("select pid, peer from peers")
+                peers = [(sqlite3.Binary(encode_peer(eval(peer))), pid) for (pid, peer) in c.fetchall()]
+                c.executemany("update peers set peer=? where pid=?", peers)
+            if version < 4:
+                c.execute("alter table peers add column updated text")
+                c.execute("select pid, peer from peers")
+                peers = [(decode_peer(peer).updated, pid) for (pid, peer) in c.fetchall()]
+                c.executemany("update peers set updated=? where pid=?", peers)
+            if version < 5:
+                c.execute("drop index if exists peers_updated")
+                c.execute("create index peers_updated on peers (updated, pid)")
+            if version < 2:
+                c.execute("select query, response from snippets")
+                if version < 1:
+                    responses = [(query, eval(response)) for (query, response) in c.fetchall()]
+                else:
+                    responses = [(query, decode_snippet_list(response)) for (query, response) in c.fetchall()]
+                c.execute("drop table snippets")
+                self._create_snippet_tables(c)
+                for (query, snippet_list) in responses:
+                    self._store_snippet_list(c, query, snippet_list)
+            else:
+                if version < 3:
+                    c.execute("create table term_peers (term text, pid text, primary key (term, pid))")
+                if version < 4:
+                    c.execute("alter table snippet_store add column found text")
+                    c.execute("select sid, snippet from snippet_store")
+                    found = [(decode_snippet(snippet, []).found, sid) for (sid, snippet) in c.fetchall()]
+                    c.executemany("update snippet_store set found=? where sid=?", found)
+                    c.execute("create index snippet_store_found on snippet_store (found)")
+                    c.execute("create index postings_sid on postings (sid)")
+                    c.execute("create index origins_pid on origins (pid)")
+                    c.execute("create index term_peers_pid on term_peers (pid)")
+                    c.execute("create table queries (query text primary key, accessed text)")
+                    c.execute("create index queries_accessed on queries (accessed)")
+                if version < 6:
+                    c.execute("create table meta (name text primary key, value blob)")
+                if version < 7:
+                    c.execute("create index origins_sid on origins (sid)")
+                    self._create_snippet_text(c)
+                    if self.searchable:
+                        c.execute("select sid, snippet from snippet_store")
+                        texts = [(sid, snippet.title, snippet.summary) for (sid, snippet) in 
+                                 ((sid, decode_snippet(data, [])) for (sid, data) in c.fetchall())]
+                        c.executemany("insert into snippet_text (rowid, title, summary) values (?,?,?)", texts)
+                if version < 8:
+                    c.execute("alter table queries add column fetched text")
+                    c.execute("alter table queries add column fetched_from text")
+                if version < 9:
+                    self._rekey_snippets(c)
+                if version < 10:
+                    c.execute("alter table snippet_store add column stored text")
+                    c.execute("update snippet_store set stored=?", (right_now(), ))
+                    c.execute("drop index if exists snippet_store_found")
+                    c.execute("create index snippet_store_stored on snippet_store (stored)")
+            if version < 3:
+                c.execute("insert or ignore into term_peers select query, pid from origins order by rowid")
+            if version < 4:
+                now = right_now()
+                c.execute("insert or ignore into queries (query, accessed) select distinct query, ? from postings", (now, ))
+                c.execute("insert or ignore into queries (query, accessed) select distinct term, ? from term_peers", (now, ))
+            c.execute("pragma user_version = %d" % SNIPDEX_CACHE_VERSION)
+        if version < 4:
+            c.execute("pragma auto_vacuum = incremental")
+            c.execute("vacuum")  # needed to change auto_vacuum
+        c.close()
+
+
+    def _rekey_snippets(self, c):
+        """Stores the snippets by the key of their current signature (see
+           get_signature()). Snippets that get the same key are folded into
+           the one with the lowest snippet id.
+           @c   cursor inside transaction()
+        """
+        c.execute("select name, value from meta where name like 'dictionary:%'")
+        for (name, value) in sorted(c.fetchall(), key=lambda row: int(row[0].split(':')[1])):
+            self.codec.add_dictionary(int(name.split(':')[1]), str(value))
+        sid_by_key = dict()
+        folded = dict()  # sid -> sid of the snippet with the same key
+        c.execute("select sid, snippet from snippet_store order by sid")
+        for (sid, data) in c.fetchall():
+            key = signature_key(self.codec.decode_snippet(data, []).get_signature())
+            if key in sid_by_key:
+                folded[sid] = sid_by_key[key]
+            else:
+                sid_by_key[key] = sid
+        c.execute("update snippet_store set signature=null")
+        c.executemany("update snippet_store set signature=? where sid=?", 
+                      [(sqlite3.Binary(key), sid) for (key, sid) in sid_by_key.iteritems()])
+        for (sid, into) in folded.iteritems():
+            c.execute("update postings set sid=? where sid=?", (into, sid))
+            c.execute("update or ignore origins set sid=? where sid=?", (into, sid))
+            c.execute("delete from origins where sid=?", (sid, ))
+            c.execute("delete from snippet_store where sid=?", (sid, ))
+            if self.searchable:
+                c.execute("delete from snippet_text where rowid=?", (sid, ))
+        if folded:  # a query keeps the best ranked posting of a folded snippet
+            c.execute("delete from postings where exists (select 1 from postings p where "
+                      "p.query=postings.query and p.sid=postings.sid and p.rank<postings.rank)")
+            self.logger.debug("Cache: folded " + str(len(folded)) + " snippets with the same signature")
+
+
+    def close(self):
+        """Stops the compactor, writes the pending access times, updated times 
+           of peers, and the bloom filter"""
+        if self.compactor:
+            self.compactor.stop()
+            self.compactor = None
+        with self.transaction() as c:
+            c.execute("insert or replace into meta values ('bloom', ?)", 
+                      (sqlite3.Binary(encode_bloom_filter(self.bloom)), ))
+            if self.peer_cache is self:
+                self._flush_peers(c)
+        self.cache.close()
+        while self.readers:
+            self.readers.pop().close()
+
+
+    @contextmanager
+    def transaction(self):
+        """Groups cache writes into a single transaction. Transactions
+           may be nested, only the outermost one commits (or rolls back
+           if an exception occurs). The write lock is taken at the start,
+           so reads inside a transaction see no concurrent changes.
+           Other threads wait for the outermost transaction to finish.
+           @return  a cursor
+        """
+        self.lock.acquire()
+        c = self.cache.cursor()
+        began = False
+        try:
+            if self.depth == 0:
+                self.owner = current_thread()
+                self._forget_evicted()
+                c.execute("begin immediate")  # may fail if the database is locked
+                began = True
+                self.changes = self.cache.total_changes
+                if self.bloom.count > self.bloom.capacity or self.bloom.stale > self.bloom.count / 2:
+                    self._rebuild_bloom_filter(c)
+        except:
+            try:
+                if began:
+                    c.execute("rollback")
+            finally:
+                c.close()
+                if self.depth == 0:
+                    self.owner = None
+                self.lock.release()
+            raise
+        self.depth += 1
+        try:
+            yield c
+        except:
+            self.depth -= 1
+            if self.depth == 0:
+                c.execute("rollback")
+                self.hot.clear()  # may contain responses that were rolled back
+                self.known_peers.clear()  # and peers
+            raise
+        else:
+            self.depth -= 1
+            if self.depth == 0:
+                with self.access_lock:  # readers keep adding
+                    (accessed, self.accessed) = (self.accessed, dict())
+                if accessed:  # keeps the freshness of existing queries
+                    c.executemany("update queries set accessed=? where query=?", 
+                                  [(when, query) for (query, when) in accessed.iteritems()])
+                    c.executemany("insert or ignore into queries (query, accessed) values (?,?)", accessed.items())
+                if self.peer_cache is self and self.known_peers.flush_due():
+                    self._flush_peers(c)
+                c.execute("commit")
+                self.metrics.count("transactions")
+                self.metrics.count("rows_written", self.cache.total_changes - self.changes)
+        finally:
+            c.close()
+            if self.depth == 0:
+                self.owner = None
+            self.lock.release()
+
+
+    @contextmanager
+    def reading(self):
+        """Gives a cursor for reads, in a read transaction, so that several
+           statements see the same version of the cache. The connection comes
+           from a pool, so readers do not wait for each other nor for the
+           writer (WAL). Inside transaction() the writer's connection is used, 
+           to see its own changes.
+           @return  a cursor
+        """
+        if self.owner is current_thread():
+            c = self.cache.cursor()
+            try:
+                yield c
+            finally:
+                c.close()
+            return
+        try:
+            connection = self.readers.pop()
+        except IndexError:
+            connection = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        c = connection.cursor()
+        c.execute("begin")
+        try:
+            yield c
+        finally:
+            c.execute("rollback")  # nothing was written
+            c.close()
+            self.readers.append(connection)
+
+
+    def _forget_evicted(self):
+        """Removes the queries and peers that the compactor evicted from memory"""
+        while self.evicted:
+            try:
+                (kind, key) = self.evicted.popleft()
+            except IndexError:  # another thread was first
+                break
+            if kind == 'query':
+                self.hot.discard(key)
+                self.bloom.stale += 1
+            else:
+                self.known_peers.discard(key)
+
+
+    def _load_bloom_filter(self):
+        """Takes the bloom filter that close() stored. It is removed from the
+           meta table, so if Snipdex stops without close() (and the filter 
+           misses queries cached afterwards), it is rebuilt next time.
+        """
+        with self.transaction() as c:
+            c.execute("select value from meta where name='bloom'")
+            row = c.fetchone()
+            bloom = None
+            if row:
+                c.execute("delete from meta where name='bloom'")
+                try:
+                    bloom = decode_bloom_filter(row[0])
+                except ValueError as ex:
+                    self.logger.warning("Warning: " + repr(ex))
+            if bloom is None or bloom.capacity < self.max_queries:
+                self._rebuild_bloom_filter(c)
+            else:
+                self.bloom = bloom
+
+
+    def _load_dictionaries(self):
+        """Gives the codec the dictionaries of the compressed snippets, 
+           the last one is used to compress new snippets. If there is 
+           none yet, one is trained if the cache is large enough.
+        """
+        with self.transaction() as c:
+            c.execute("select name, value from meta where name like 'dictionary:%'")
+            for (name, value) in sorted(c.fetchall(), key=lambda row: int(row[0].split(':')[1])):
+                self.codec.add_dictionary(int(name.split(':')[1]), str(value))
+            if self.codec.dictionary_id is None:
+                self._train_dictionary(c)
+
+
+    def _train_dictionary(self, c):
+        """Makes the shared dictionary of the codec from a sample of the 
+           snippet store: typical snippets, with the same field values, 
+           URL prefixes and peer ids as the snippets to come.
+           @c   cursor inside transaction()
+        """
+        c.execute("select snippet from snippet_store order by random() limit ?", (CACHE_DICTIONARY_SAMPLES, ))
+        samples = set(self.codec.decompress(row[0]) for row in c.fetchall())
+        if len(samples) < CACHE_DICTIONARY_SAMPLES / 2:
+            return
+        dictionary = "".join(samples)[-CACHE_DICTIONARY_SIZE:]  # deflate refers back to the last bytes
+        dictionary_id = (self.codec.dictionary_id or 0) + 1
+        c.execute("insert or replace into meta values (?,?)", 
+                  ("dictionary:" + str(dictionary_id), sqlite3.Binary(dictionary)))
+        self.codec.add_dictionary(dictionary_id, dictionary)
+        self.logger.debug("Cache: trained compression dictionary " + str(dictionary_id))
+
+
+    def _rebuild_bloom_filter(self, c):
+        """Fills a new bloom filter with the queries and terms in the cache, 
+           when the old one has too many (stale) queries.
+           @c   cursor inside transaction()
+        """
+        c.execute("select count(*) from queries")
+        bloom = BloomFilter(max(self.max_queries, 2 * c.fetchone()[0]))
+        c.execute("select distinct query from postings")
+        for row in c:
+            bloom.add(row[0])
+        c.execute("select distinct term from term_peers")
+        for row in c:
+            bloom.add(row[0])
+        self.bloom = bloom
+        self.logger.debug("Cache: bloom filter with " + str(bloom.count) + " queries")
 
 
     def _update_snippets_return_pids_not_there(self, peer_list, snippet_list, default_status=None):
@@ -192,7 +1110,7 @@ class SnipdexCache(object):
                         del to_be_inserted[pid]
                 else:
                     new_origins.append((pid, status, score)) 
-            snippet.origins = new_origins 
+            snippet.origins = Origins(new_origins)
         return_list = list()
         for pid in to_be_inserted:
             (status, score) = to_be_inserted[pid]
@@ -202,37 +1120,188 @@ class SnipdexCache(object):
         return return_list
                 
 
+    @timed
     def insert_response(self, query, peer_list, snippet_list, default_status=None):
         """ Caches a search response
             @query         original query
             @peer_list     a list of peers: PeerList()
             @snippet_list  a list of snippets: SnippetList()
         """
-        query_text = query.normalized_text()
-        #print "INSERT QUERY:", query_text
-        c = self.cache.cursor()  
-        #insert peers
+        query_text = query.normalized().text
+        with self.transaction() as c:
+            self._insert_peers(c, peer_list)
+            # insert snippets
+            new_snippet_list = snippet_list.deepcopy() # do not change snippet_list
+            to_be_inserted = self._update_snippets_return_pids_not_there(peer_list, new_snippet_list, default_status)
+            if to_be_inserted: # add an empty snippet with origin_ids
+                new_snippet_list.append(Snippet(origins=to_be_inserted))
+            (stored_list, size) = self._store_snippet_list(c, query_text, new_snippet_list)
+            self.hot.put(query_text, stored_list, size)
+            self._touch([query_text])
+
+
+    def _store_snippet_list(self, c, query_text, snippet_list):
+        """ Stores snippet_list as the postings of a query. New snippets are added to
+            the snippet store, but only postings and origins that differ from what is
+            already stored for the query are written.
+            Snippets with the same signature are folded into the first one, and all 
+            origin-only snippets into one last snippet (with snippet id 0).
+            @c             cursor inside transaction()
+            @query_text    normalized query
+            @snippet_list  a list of snippets: SnippetList(), its snippets may be changed
+            @return        (the stored SnippetList(), its approximate size in bytes)
+        """
+        self.bloom.add(query_text)  # before any reader can see it
+        stored_list = SnippetList()
+        by_key = dict()   # signature_key -> (snippet, encoded snippet)
+        empty = None      # origin-only snippet
+        for snippet in snippet_list:
+            signature = snippet.get_signature()
+            if not signature:
+                if empty is None:
+                    empty = Snippet(origins=[])
+                empty.add_origins(snippet.origins)
+                continue
+            key = signature_key(signature)
+            if key in by_key:
+                by_key[key][0].add_origins(snippet.origins)
+            else:
+                by_key[key] = (snippet, self.codec.compress(encode_snippet(snippet)))
+                stored_list.append(snippet)
+        if empty is not None:
+            stored_list.append(empty)
+
+        # snippet store: look up all signatures at once, add new or changed snippets,
+        # and renew the stored time of the others (see CacheCompactor.remove_expired())
+        now = right_now()
+        sid_by_key = dict()
+        unchanged = list()
+        keys = list(by_key)
+        for i in range(0, len(keys), CACHE_MAX_VARIABLES):
+            chunk = keys[i:i + CACHE_MAX_VARIABLES]
+            c.execute("select signature, sid, snippet from snippet_store where signature in (" + 
+                      ",".join("?" * len(chunk)) + ")", [sqlite3.Binary(key) for key in chunk])
+            for (key, sid, data) in c.fetchall():
+                key = str(key)
+                sid_by_key[key] = sid
+                if str(data) != by_key[key][1]:  # newest version wins
+                    snippet = by_key[key][0]
+                    c.execute("update snippet_store set snippet=?, found=?, stored=? where sid=?", 
+                              (sqlite3.Binary(by_key[key][1]), snippet.found, now, sid))
+                    if self.searchable:
+                        c.execute("update snippet_text set title=?, summary=? where rowid=?",
+                                  (snippet.title, snippet.summary, sid))
+                else:
+                    unchanged.append((now, sid, now))
+        c.executemany("update snippet_store set stored=? where sid=? and (stored is null or stored<?)", unchanged)
+        size = 0
+        sids = list()
+        for snippet in stored_list:
+            if snippet is empty:
+                sids.append(CACHE_EMPTY_SID)
+                continue
+            key = signature_key(snippet.get_signature())
+            if not key in sid_by_key:
+                c.execute("insert into snippet_store (signature, snippet, found, stored) values (?,?,?,?)", 
+                          (sqlite3.Binary(key), sqlite3.Binary(by_key[key][1]), snippet.found, now))
+                sid_by_key[key] = c.lastrowid
+                if self.searchable:
+                    c.execute("insert into snippet_text (rowid, title, summary) values (?,?,?)",
+                              (c.lastrowid, snippet.title, snippet.summary))
+                self.codec.added += 1
+            sids.append(sid_by_key[key])
+            size += len(by_key[key][1])
+
+        # postings: only write the ranks that changed
+        c.execute("select rank, sid from postings where query=?", (query_text, ))
+        old_postings = dict(c.fetchall())
+        c.executemany("insert or replace into postings values (?,?,?)",
+                      [(query_text, rank, sid) for (rank, sid) in enumerate(sids) if old_postings.get(rank) != sid])
+        if old_postings and max(old_postings) >= len(sids):  # the compactor may leave gaps
+            c.execute("delete from postings where query=? and rank>=?", (query_text, len(sids)))
+
+        # origins: only rewrite the origins of snippets that changed
+        old_origins = self._origins_by_query_text(c, query_text)
+        for (sid, snippet) in zip(sids, stored_list):
+            origins = [tuple(origin) for origin in snippet.origins]
+            size += 32 * len(origins)
+            if old_origins.pop(sid, None) != origins:
+                c.execute("delete from origins where query=? and sid=?", (query_text, sid))
+                c.executemany("insert or replace into origins values (?,?,?,?,?)", 
+                              [(query_text, sid, pid, status, score) for (pid, status, score) in origins])
+        for sid in old_origins:
+            c.execute("delete from origins where query=? and sid=?", (query_text, sid))
+        if self.codec.dictionary_id is None and self.codec.added >= CACHE_DICTIONARY_SAMPLES:
+            self.codec.added = 0
+            self._train_dictionary(c)
+        return (stored_list, size)
+
+
+    def _origins_by_query_text(self, c, query_text):
+        """Returns a dictionary with for each snippet id the list of stored origins for a query"""
+        origins = dict()
+        c.execute("select sid, pid, status, score from origins where query=? order by rowid", (query_text, ))
+        for (sid, pid, status, score) in c:
+            origins.setdefault(sid, []).append((pid, status, score))
+        return origins
+
+
+    def _insert_peers(self, c, peer_list):
+        """ Stores the new and updated peers of peer_list in one statement
+            @c             cursor inside transaction()
+            @peer_list     a list of peers: PeerList()
+        """
         for (peer, status, score) in peer_list:
             if peer.pid is None:
                 raise ValueError('No valid peer id assigned.')
-            if not peer.pid in self.known_peers:     # new insert
-                self.known_peers[peer.pid] = peer
-                c.execute("insert into peers values(?,?)", (peer.pid, repr(peer)))
-                self.cache.commit()
-            elif self.known_peers[peer.pid].older_than(peer): # update
-                self.known_peers[peer.pid] = peer   
-                c.execute("update peers set peer=? where pid=?", (repr(peer), peer.pid))
-                self.cache.commit()
-        # insert snippets
-        new_snippet_list = snippet_list.deepcopy() # do not change snippet_list
-        to_be_inserted = self._update_snippets_return_pids_not_there(peer_list, new_snippet_list, default_status)
-        if to_be_inserted: # add an empty snippet with origin_ids
-            new_snippet_list.append(Snippet(origins=to_be_inserted))
-        try:
-            c.execute("insert into snippets values(?,?)", (query_text, repr(new_snippet_list)))  
-        except sqlite3.IntegrityError:
-            c.execute("update snippets set response=? where query=?", (repr(new_snippet_list), query_text))
-        self.cache.commit()
+        (changed, touched) = self._changed_peers(peer_list)
+        if touched:  # written later, see _flush_peers()
+            self.known_peers.touch(touched.values())
+            self.metrics.count("peers_touched", len(touched))
+        if not changed:
+            return
+        if self.peer_cache is not self:  # a shard: peers are stored in one place
+            with self.peer_cache.transaction() as peer_c:
+                self.peer_cache._insert_peers(peer_c, [(peer, None, None) for peer in changed.values()])
+            return
+        c.executemany("insert or replace into peers values(?,?,?)", 
+                      [(peer.pid, sqlite3.Binary(encode_peer(peer)), peer.updated) for peer in changed.values()])
+        self.known_peers.put_many(changed.values())
+        self.metrics.count("peers_written", len(changed))
+
+
+    def _changed_peers(self, peer_list):
+        """Compares the peers of peer_list with the stored ones.
+           @return  (changed, touched): dictionaries pid -> Peer of the peers
+                    that are new or changed, and of the peers that only have
+                    a newer updated time (see Peer.same_as())
+        """
+        known_peers = self.known_peers.get_many([peer.pid for (peer, status, score) in peer_list])
+        changed = dict()
+        touched = dict()
+        for (peer, status, score) in peer_list:
+            if not peer.pid in known_peers:
+                changed[peer.pid] = peer
+            elif known_peers[peer.pid].older_than(peer): # update
+                if known_peers[peer.pid].same_as(peer):
+                    touched[peer.pid] = peer
+                else:
+                    changed[peer.pid] = peer
+            else:
+                continue
+            known_peers[peer.pid] = peer
+        return (changed, touched)
+
+
+    def _flush_peers(self, c):
+        """Writes the updated times of the touched peers (see PeerDirectory.touch())
+           in one statement. The peer itself is not written: the updated column 
+           overrides the time stored with the peer.
+           @c   cursor inside transaction()
+        """
+        touched = self.known_peers.take_touched()
+        c.executemany("update peers set updated=? where pid=? and (updated is null or updated<?)",
+                      [(updated, pid, updated) for (pid, updated) in touched.iteritems()])
 
 
     def update_response(self, query, peer_list, snippet_list, default_status=None):
@@ -241,10 +1310,11 @@ class SnipdexCache(object):
             @peer_list     a list of peers: PeerList()
             @snippet_list  a list of snippets: SnippetList()
         """
-        (old_peer_list, old_snippet_list) = self.response_by_query(query)
-        old_peer_list.merge(peer_list)
-        old_snippet_list.merge(snippet_list)
-        self.insert_response(query, old_peer_list, old_snippet_list, default_status)
+        with self.transaction():
+            (old_peer_list, old_snippet_list) = self.response_by_query(query)
+            old_peer_list.merge(peer_list)
+            old_snippet_list.merge(snippet_list)
+            self.insert_response(query, old_peer_list, old_snippet_list, default_status)
 
 
     def update_response_full(self, query, peer_list, snippet_list):
@@ -253,49 +1323,141 @@ class SnipdexCache(object):
             @peer_list     a list of peers: PeerList()
             @snippet_list  a list of snippets: SnippetList()
         """
-        self.update_response(query, peer_list, snippet_list)
-        self.update_response_backoff(query, peer_list)
+        self.update_response_full_many([(query, peer_list, snippet_list)])
+
+
+    @timed
+    def update_response_full_many(self, updates):
+        """ Caches several search responses, and their peer lists for the single
+            terms (see update_response_backoff_many()), in one transaction.
+            @updates       list of (query, peer_list, snippet_list), where a 
+                           snippet_list of None only updates the single terms
+        """
+        (pids_by_term, peers) = backoff_pids([(query, peer_list) for (query, peer_list, snippet_list) in updates])
+        self._update_many([update for update in updates if update[2] is not None], pids_by_term, peers)
+
+
+    def _update_many(self, updates, pids_by_term, peers):
+        """Caches full responses and term_peers pairs in one transaction.
+           @updates       list of (query, peer_list, snippet_list)
+           @pids_by_term  the pids to add to the term_peers index, see backoff_pids()
+           @peers         the peers of pids_by_term
+        """
+        with self.transaction() as c:
+            for (query, peer_list, snippet_list) in updates:
+                self.update_response(query, peer_list, snippet_list)
+                self._set_fetched(query.normalized().text, peer_list)
+            self._insert_peers(c, peers)
+            self._store_term_peers(c, pids_by_term)
+
+
+    def _set_fetched(self, query_text, peer_list):
+        """Records that the response to a query was just fetched from the
+           network, and from which peers (those with status 'DONE'). If no
+           peer answered, nothing was fetched: the query stays as it was.
+        """
+        pids = " ".join(peer.pid for (peer, status, score) in peer_list if status == 'DONE')
+        if not pids:
+            return
+        with self.transaction() as c:
+            now = right_now()
+            c.execute("insert or ignore into queries (query, accessed) values (?,?)", (query_text, now))
+            c.execute("update queries set fetched=?, fetched_from=? where query=?", (now, pids, query_text))
+
+
+    @timed
+    def freshness(self, query):
+        """Tells whether the cached response to a query can be served as is.
+           @query    Query object
+           @return   (state, pids), where state is 'fresh' (fetched at most 
+                     fresh_seconds ago), 'stale' (at most stale_seconds ago),
+                     'expired' or 'missing' (never fetched, or from no 
+                     peer); and pids are the peers the response was fetched from
+        """
+        query_text = query.normalized().text
+        self._forget_evicted()
+        if query_text not in self.bloom:  # never cached
+            self._skip(1)
+            return ('missing', [])
+        with self.reading() as c:
+            c.execute("select fetched, fetched_from from queries where query=?", (query_text, ))
+            row = c.fetchone()
+        if row is None or row[0] is None or not row[1]:
+            return ('missing', [])
+        (fetched, fetched_from) = row
+        age = datetime.datetime.utcnow() - datetime.datetime.strptime(fetched, "%Y-%m-%d %H:%M:%S")
+        age = age.days * 86400 + age.seconds
+        pids = fetched_from.split() if fetched_from else []
+        if age <= self.fresh_seconds:
+            return ('fresh', pids)
+        elif age <= self.stale_seconds:
+            return ('stale', pids)
+        else:
+            return ('expired', pids)
 
 
     def update_response_backoff(self, query, peer_list):
-        """ Caches a search response for the query, and the peer list for the single terms
+        """ Caches the peer list for the single terms, the prefixes and the full query
+            in the term_peers index, see update_response_backoff_many().
             @query         original query
             @peer_list     a list of peers: PeerList()
         """
-        new_peer_list = PeerList()
-        for (peer, status, score) in peer_list: # set everything to TODO.
-            new_peer_list.append(peer, 'TODO')
-        query = query.normalized_text()
-        parts = query.split('+')
-        if len(parts) > 1:
-            i = 0
-            for part in parts:
-                i += 1
-                if i > 1 and i < len(parts):
-                    self.update_response(Query({'q': "+".join(parts[:i])}), new_peer_list, SnippetList(), 'TODO') 
-                self.update_response(Query({'q': part}), new_peer_list, SnippetList(), 'TODO')
+        self.update_response_backoff_many([(query, peer_list)])
+
+
+    @timed
+    def update_response_backoff_many(self, updates):
+        """ Caches the peer lists of several queries for their single terms, prefixes
+            and full queries (see backoff_terms()). The (term, pid) pairs that are
+            already stored are read in one statement per CACHE_MAX_VARIABLES terms,
+            only the new pairs are written, all in one transaction.
+            @updates       list of (query, peer_list)
+        """
+        (pids_by_term, peers) = backoff_pids(updates)
+        self._update_many([], pids_by_term, peers)
+
+
+    def _store_term_peers(self, c, pids_by_term):
+        """Adds the (term, pid) pairs that are not yet in the term_peers index
+           @c             cursor inside transaction()
+           @pids_by_term  dictionary term -> list of pids
+        """
+        terms = list(pids_by_term)
+        stored = set()
+        for i in range(0, len(terms), CACHE_MAX_VARIABLES):
+            chunk = terms[i:i + CACHE_MAX_VARIABLES]
+            c.execute("select term, pid from term_peers where term in (" + ",".join("?" * len(chunk)) + ")", chunk)
+            stored.update(c.fetchall())
+        new_pairs = [(term, pid) for term in terms for pid in pids_by_term[term] if not (term, pid) in stored]
+        for (term, pid) in new_pairs:
+            self.bloom.add(term)  # before any reader can see it
+        c.executemany("insert or ignore into term_peers values (?,?)", new_pairs)
+        self._touch(terms)
   
 
+    @timed
     def response_by_query(self, query, default_status=None):
         """Returns a peer_list and snippet_list that exactly match a query from the cache
            @query    Query object
         """
-        query_text = query.normalized_text()
+        query_text = query.normalized().text
         #print "RETRIEVE QUERY:", query_text
         peer_list = PeerList()
-        snippet_list = SnippetList()
-        c = self.cache.cursor()
-        c.execute("select * from snippets where query=?", (query_text, ))
-        for row in c:
-            #print "ROW", query_text, repr(row)
-            snippet_list = eval(row[1])
+        snippet_list = self._snippet_list_by_query_text(query_text)
+        if snippet_list is None:
+            self.metrics.count("exact_misses")
+            snippet_list = SnippetList()
+        else:
+            self.metrics.count("exact_hits")
+            known_peers = self.known_peers.get_many([pid for snippet in snippet_list 
+                                                     for (pid, status, score) in snippet.origins])
             for snippet in snippet_list:
                 for (pid, status, score) in snippet.origins:
-                    if self.known_peers.has_key(pid):
+                    if known_peers.has_key(pid):
                         if default_status:    # change name to 'overwrite_status' !
                             status = default_status
-                        score = len(query_text.split('+')) # query length is score (TODO: remove score from database?)
-                        peer = self.known_peers[pid]
+                        score = query.length() # query length is score (TODO: remove score from database?)
+                        peer = known_peers[pid]
                         peer_list.merge_single(peer, status, score)                    
                     else:
                         self.logger.warning("Warning: Unknown persistent peer id '" + pid + "' in cached snippet")
@@ -304,34 +1466,185 @@ class SnipdexCache(object):
         return (peer_list, snippet_list)
 
 
+    def _snippet_list_by_query_text(self, query_text):
+        """Returns a private copy of the cached snippet list for a normalized
+           query, or None if the query is not cached. Uses the in-memory 
+           LRU before going to disk; misses are remembered as well.
+        """
+        self._forget_evicted()
+        if query_text not in self.bloom:  # never cached
+            self._skip(1)
+            return None
+        version = self.hot.version
+        try:
+            snippet_list = self.hot[query_text]
+        except KeyError:
+            with self.reading() as c:
+                c.execute("select p.sid, s.snippet from postings p left join snippet_store s on s.sid = p.sid "
+                          "where p.query=? order by p.rank", (query_text, ))
+                rows = c.fetchall()
+                if rows:
+                    origins = self._origins_by_query_text(c, query_text)
+            snippet_list = None
+            size = 0
+            if rows:
+                start = time.time()
+                snippet_list = SnippetList()
+                for (sid, data) in rows:
+                    if sid == CACHE_EMPTY_SID:
+                        snippet_list.append(Snippet(origins=origins.get(sid, [])))
+                    elif data is not None:
+                        snippet_list.append(self.codec.decode_snippet(data, origins.get(sid, [])))
+                        size += len(data)
+                    size += 32 * len(origins.get(sid, []))
+                self.metrics.observe("decode", time.time() - start)
+            self.hot.put(query_text, snippet_list, size, version) # unless a writer was first
+        if snippet_list is None:
+            return None
+        self._touch([query_text])
+        return snippet_list.deepcopy()
+
+
+    @timed
+    def search_snippets(self, query, count=CACHE_SEARCH_RESULTS):
+        """Searches the titles and summaries of all cached snippets, so queries 
+           that were never cached get results as well. All terms must match,
+           snippets are ranked by BM25, a title match counts double.
+           The peers of the snippets did not answer this query, their status
+           is 'TODO'.
+           @query   Query object
+           @count   maximum number of snippets
+           @return  (peer_list, snippet_list), like response_by_query()
+        """
+        peer_list = PeerList()
+        snippet_list = SnippetList()
+        terms = [term for term in query.normalized().words if term and term[0] != '#']  # no hashtags
+        if not self.searchable or not terms:
+            return (peer_list, snippet_list)
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        with self.reading() as c:
+            c.execute("select t.rowid, s.snippet from snippet_text t join snippet_store s on s.sid = t.rowid "
+                      "where snippet_text match ? order by bm25(snippet_text, 2.0, 1.0) limit ?", (match, count))
+            rows = c.fetchall()
+            origins = dict()
+            if rows:
+                c.execute("select sid, pid from origins where sid in (" + ",".join("?" * len(rows)) + 
+                          ") order by rowid", [sid for (sid, data) in rows])
+                for (sid, pid) in c:
+                    pids = origins.setdefault(sid, [])
+                    if pid not in pids:
+                        pids.append(pid)
+        known_peers = self.known_peers.get_many([pid for pids in origins.values() for pid in pids])
+        score = len(terms)
+        for (sid, data) in rows:
+            pids = [pid for pid in origins.get(sid, []) if pid in known_peers]
+            snippet_list.append(self.codec.decode_snippet(data, [(pid, 'TODO', score) for pid in pids]))
+            for pid in pids:
+                peer_list.merge_single(known_peers[pid], 'TODO', score)
+        return (peer_list, snippet_list)
+
+
+    def statistics(self):
+        """Returns a dictionary with statistics on the use of the cache, 
+           including the counters and the latency of each operation (see
+           CacheMetrics.snapshot())
+        """
+        statistics = self.metrics.snapshot()
+        statistics.update({"known_peers": len(self.known_peers),
+                "hot_peers": len(self.known_peers.hot),
+                "hot_peer_hits": self.known_peers.hot.hits,
+                "hot_peer_misses": self.known_peers.hot.misses,
+                "hot_hits": self.hot.hits, 
+                "hot_misses": self.hot.misses, 
+                "hot_evictions": self.hot.evictions, 
+                "hot_queries": len(self.hot), 
+                "hot_bytes": self.hot.size,
+                "read_connections": len(self.readers),
+                "bloom_queries": self.bloom.count,
+                "bloom_bytes": len(self.bloom.bits),
+                "bloom_false_positive_rate": self.bloom.false_positive_rate(),
+                "bloom_skipped": self.skipped,
+                "compression_ratio": self.codec.ratio(),
+                "decoded_snippets": self.codec.decoded,
+                "decode_seconds": self.codec.decode_seconds})
+        return statistics
+
+
+    @timed
     def response_by_query_full(self, query, default_status=None):
         """Returns a peer_list that approximately or exactly matches a query
-           from the cache, and a snippet_list that matched exactly
+           from the cache, and a snippet_list that matched exactly.
+           The peers of all sub_queries() come from the term_peers index in
+           a single lookup, whatever the length of the query.
            @query    Query object
         """
-        query = query.normalized_text()
-        parts = query.split('+')
-        if len(parts) <= 1: # query with one term
-            return self.response_by_query(Query({'q': parts[0]}), default_status)
+        query_text = query.normalized().text
+        terms = sub_queries(query.normalized().terms)
+        pids_by_term = self._pids_by_terms(terms)
+        exact_response = self.response_by_query(query, default_status)
+        return self._merge_term_peers(query_text, terms, pids_by_term, exact_response)
+
+
+    def _touch(self, queries):
+        """Remembers the access of queries or terms, transaction() writes
+           them to the queries table (for CacheCompactor.remove_least_recent())
+        """
+        now = right_now()
+        with self.access_lock:
+            for query_text in queries:
+                self.accessed[query_text] = now
+
+
+    def _skip(self, count):
+        """Counts lookups that the bloom filter saved"""
+        with self.access_lock:
+            self.skipped += count
+
+
+    def _pids_by_terms(self, terms):
+        """Returns a dictionary term -> list of pids from the term_peers index"""
+        pids_by_term = dict()
+        self._forget_evicted()
+        probes = [term for term in terms if term in self.bloom]  # the others were never cached
+        self._skip(len(terms) - len(probes))
+        if probes:
+            with self.reading() as c:
+                for i in range(0, len(probes), CACHE_MAX_VARIABLES):
+                    chunk = probes[i:i + CACHE_MAX_VARIABLES]
+                    c.execute("select term, pid from term_peers where term in (" + ",".join("?" * len(chunk)) +
+                              ") order by rowid", chunk)
+                    for (term, pid) in c:
+                        pids_by_term.setdefault(term, []).append(pid)
+        self._touch(pids_by_term)
+        return pids_by_term
+
+
+    def _merge_term_peers(self, query_text, terms, pids_by_term, exact_response):
+        """Puts together the response of response_by_query_full()
+           @query_text      normalized query
+           @terms           its sub_queries()
+           @pids_by_term    the peers of the terms, see _pids_by_terms()
+           @exact_response  (peer_list, snippet_list) of response_by_query()
+        """
+        self._forget_evicted()
+        known_peers = self.known_peers.get_many([pid for pids in pids_by_term.values() for pid in pids])
+        peer_list = PeerList()
+        for term in terms[:-1]:  # approximate matches first, the full query is last
+            score = len(term.split('+'))
+            for pid in pids_by_term.get(term, ()):
+                if pid in known_peers:
+                    peer_list.merge_single(known_peers[pid], 'TODO', score)
+        (exact_peer_list, snippet_list) = exact_response
+        peer_list.merge(exact_peer_list)
+        for pid in pids_by_term.get(query_text, ()):
+            if pid in known_peers:
+                peer_list.merge_single(known_peers[pid], 'TODO', len(terms[-1].split('+')))
+        if snippet_list:
+            self.metrics.count("full_exact_hits")
+        elif peer_list:
+            self.metrics.count("full_backoff_hits")  # only peers to ask
         else:
-            (peer_list, snippet_list) = self.response_by_query(Query({'q': parts[0]}), 'TODO')
-        new_peer_list = None
-        first_ok = peer_list
-        if len(parts) == 2: # query with two terms
-            (new_peer_list, useless_snippet_list) = self.response_by_query(Query({'q': parts[1]}), 'TODO')
-        else: # query with more than two terms
-            (new_peer_list, useless_snippet_list) = self.response_by_query_full(Query({'q': "+".join(parts[1:])}), 'TODO') # last part
-            for i in range(2, len(parts)): # first part
-                if new_peer_list:
-                    peer_list.merge(new_peer_list)
-                    (new_peer_list, useless_snippet_list) = self.response_by_query(Query({'q': "+".join(parts[:i])}),'TODO')
-        snippet_list = SnippetList()
-        if new_peer_list:
-            peer_list.merge(new_peer_list)
-            if first_ok: 
-                (new_peer_list, snippet_list) = self.response_by_query(Query({'q': query}), default_status) #full query
-                if new_peer_list:
-                    peer_list.merge(new_peer_list)
+            self.metrics.count("full_misses")
         return (peer_list, snippet_list)
 
 
@@ -345,20 +1658,893 @@ class SnipdexCache(object):
             raise NameError("Own peer id not defined.")
 
 
+    @timed
     def get_all_peers_by_page(self, page):
         """Returns all peers per page, ten per page.
         """
         peer_list = PeerList()
-        peer_ids = sorted(self.known_peers)
         if page < 1:
             page = 1
-        first = (page - 1) * 10
-        last = first + 10
-        for peer_id in peer_ids[first:last]:
-            peer_list.append(self.known_peers[peer_id], 'TODO', 1.0)
+        for peer in self.known_peers.page((page - 1) * 10, 10):
+            peer_list.append(peer, 'TODO', 1.0)
+        return (peer_list, SnippetList())
+
+
+    @timed
+    def get_peers_after(self, after=None, count=CACHE_PAGE_SIZE, since=None):
+        """Returns the next page of peers (keyset pagination), so walking all 
+           peers costs the same for every page. Peers are ordered by pid, or in
+           delta mode (since given) only the peers updated after since are 
+           returned, ordered by updated and pid: pass the updated and pid of 
+           the last peer of a page as since and after to get the next page.
+           @after   pid of the last peer of the previous page, or None
+           @count   page size, at most CACHE_MAX_PAGE_SIZE
+           @since   time stamp 'yyyy-mm-dd hh:mm:ss' or None
+        """
+        count = max(1, min(count, CACHE_MAX_PAGE_SIZE))
+        peer_list = PeerList()
+        for peer in self.known_peers.after(after, count, since):
+            peer_list.append(peer, 'TODO', 1.0)
         return (peer_list, SnippetList())
         
 
+class ShardedCache(object):
+    """A cache split over several files, so that searches can write to the
+       cache at the same time. The snippets, term peers and queries are in 
+       the shard of their query or term (see shard_number()), each shard 
+       is a SnipdexCache. The peers, and the peer's own queries, are in 
+       the main file, shared by all shards. Lookups that need several 
+       shards query them in parallel.
+       Limits such as max_queries and max_bytes hold for each file.
+       The latency of each operation is measured on the sharded cache as 
+       a whole, the counters are those of all files added up.
+    """
+
+    __slots__ = [ "peers", "shards", "logger", "metrics" ]
+
+    def __init__(self, filename, logger, shards, durability='normal', **options):
+        """Opens a sharded cache, an existing single file cache is split
+           first (see split_cache()).
+           @filename     the main file, the shards are in shard_filename()
+           @shards       number of shards
+           @durability   see SnipdexCache
+           @options      other options of each SnipdexCache
+        """
+        split_cache(filename, logger, shards)  # finishes an interrupted split
+        self.logger  = logger
+        self.metrics = CacheMetrics()
+        self.peers   = SnipdexCache(filename, logger, durability, shards=shards, **options)
+        self.shards  = [SnipdexCache(shard_filename(filename, number), logger, durability, 
+                                     peer_cache=self.peers, **options) for number in range(shards)]
+        if self.peers.compactor:  # removes the origins of expired peers from the shards
+            for shard in self.shards:
+                self.peers.compactor.add_shard(shard.filename, shard.evicted)
+
+
+    def _shard(self, query_text):
+        """Returns the SnipdexCache of a normalized query or term"""
+        if query_text in (SNIPDEX_QUERY_MYSELF, SNIPDEX_QUERY_REGISTER):
+            return self.peers
+        return self.shards[shard_number(query_text, len(self.shards))]
+
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.peers.close()
+
+
+    @timed
+    def insert_response(self, query, peer_list, snippet_list, default_status=None):
+        self._shard(query.normalized().text).insert_response(query, peer_list, snippet_list, default_status)
+
+
+    def update_response(self, query, peer_list, snippet_list, default_status=None):
+        self._shard(query.normalized().text).update_response(query, peer_list, snippet_list, default_status)
+
+
+    def update_response_full(self, query, peer_list, snippet_list):
+        self.update_response_full_many([(query, peer_list, snippet_list)])
+
+
+    @timed
+    def update_response_full_many(self, updates):
+        """Like SnipdexCache.update_response_full_many(), see _update_many()"""
+        self._update_many(updates)
+
+
+    def _update_many(self, updates):
+        """Writes the shards in parallel, each in one transaction.
+           @updates       list of (query, peer_list, snippet_list), where a 
+                          snippet_list of None only updates the single terms
+        """
+        (pids_by_term, peers) = backoff_pids([(query, peer_list) for (query, peer_list, snippet_list) in updates])
+        if any(self.peers._changed_peers(peers)) or self.peers.known_peers.flush_due():
+            with self.peers.transaction() as c:
+                self.peers._insert_peers(c, peers)
+        work = OrderedDict()  # shard -> (updates, pids_by_term)
+        for update in updates:
+            if update[2] is not None:
+                work.setdefault(self._shard(update[0].normalized().text), ([], OrderedDict()))[0].append(update)
+        for (term, pids) in pids_by_term.items():
+            work.setdefault(self._shard(term), ([], OrderedDict()))[1][term] = pids
+        if work:
+            in_parallel([(shard._update_many, (shard_updates, shard_pids_by_term, [])) 
+                         for (shard, (shard_updates, shard_pids_by_term)) in work.items()])
+
+
+    def update_response_backoff(self, query, peer_list):
+        self.update_response_backoff_many([(query, peer_list)])
+
+
+    @timed
+    def update_response_backoff_many(self, updates):
+        self._update_many([(query, peer_list, None) for (query, peer_list) in updates])
+
+
+    @timed
+    def freshness(self, query):
+        return self._shard(query.normalized().text).freshness(query)
+
+
+    @timed
+    def response_by_query(self, query, default_status=None):
+        return self._shard(query.normalized().text).response_by_query(query, default_status)
+
+
+    @timed
+    def response_by_query_full(self, query, default_status=None):
+        """Like SnipdexCache.response_by_query_full(), the shards of the 
+           sub-queries are queried in parallel.
+        """
+        query_text = query.normalized().text
+        terms = sub_queries(query.normalized().terms)
+        terms_by_shard = OrderedDict()
+        for term in terms:
+            terms_by_shard.setdefault(self._shard(term), []).append(term)
+        calls = [(self._shard(query_text).response_by_query, (query, default_status))]
+        calls.extend((shard._pids_by_terms, (shard_terms, )) for (shard, shard_terms) in terms_by_shard.items())
+        results = in_parallel(calls)
+        pids_by_term = dict()
+        for shard_pids_by_term in results[1:]:
+            pids_by_term.update(shard_pids_by_term)
+        return self.peers._merge_term_peers(query_text, terms, pids_by_term, results[0])
+
+
+    @timed
+    def search_snippets(self, query, count=CACHE_SEARCH_RESULTS):
+        """Like SnipdexCache.search_snippets(), searches all shards in 
+           parallel. Each shard ranks its own snippets, the results are 
+           taken from the shards in turn.
+        """
+        results = in_parallel([(shard.search_snippets, (query, count)) for shard in self.shards])
+        peer_list = PeerList()
+        snippet_list = SnippetList()
+        for (shard_peer_list, shard_snippet_list) in results:
+            peer_list.merge(shard_peer_list)
+        for rank in range(count):
+            for (shard_peer_list, shard_snippet_list) in results:
+                if rank < len(shard_snippet_list) and len(snippet_list) < count:
+                    snippet = shard_snippet_list[rank]
+                    if not snippet.get_signature() in snippet_list.signatures:
+                        snippet_list.append(snippet)
+        return (peer_list, snippet_list)
+
+
+    def statistics(self):
+        """Returns the statistics of the main file, with the query statistics
+           and counters of all shards added up, and the latency of the 
+           operations on the sharded cache"""
+        statistics = self.peers.statistics()
+        for shard in self.shards:
+            for (name, value) in shard.statistics().items():
+                if name in ("hot_hits", "hot_misses", "hot_evictions", "hot_queries", "hot_bytes", 
+                            "read_connections", "bloom_queries", "bloom_bytes", "bloom_skipped", 
+                            "decoded_snippets", "decode_seconds") or name in shard.metrics.counters:
+                    statistics[name] = statistics.get(name, 0) + value
+        statistics["latency"] = self.metrics.snapshot()["latency"]
+        statistics["shards"] = len(self.shards)
+        return statistics
+
+
+    def get_my_peer_id(self):
+        return self.peers.get_my_peer_id()
+
+
+    @timed
+    def get_all_peers_by_page(self, page):
+        return self.peers.get_all_peers_by_page(page)
+
+
+    @timed
+    def get_peers_after(self, after=None, count=CACHE_PAGE_SIZE, since=None):
+        return self.peers.get_peers_after(after, count, since)
+
+
+class LRUCache(object):
+    """A bounded mapping that forgets the least recently used items first.
+       Each item has a size (in bytes, or any other unit). Items are
+       evicted once either the number of items or their total size
+       exceeds its limit. It may be shared by threads.
+    """
+
+    __slots__ = [ "items", "max_items", "max_size", "size", "hits", "misses", "evictions",
+                  "version", "lock" ]
+
+    def __init__(self, max_items, max_size):
+        self.items     = OrderedDict()   # key -> (value, size), least recent first
+        self.max_items = max_items
+        self.max_size  = max_size
+        self.size      = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.version   = 0  # changes on every put(), discard() or clear()
+        self.lock      = Lock()
+
+    def put(self, key, value, size=0, version=None):
+        """Adds or replaces an item, and makes it the most recently used one
+           @version  if given, only put if nothing changed since this version
+        """
+        self.put_many([(key, value, size)], version)
+
+    def put_many(self, items, version=None):
+        """Adds or replaces several (key, value, size) items, see put()"""
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            for (key, value, size) in items:
+                self._discard(key)
+                if self.max_items < 1 or size > self.max_size:
+                    continue
+                self.items[key] = (value, size)
+                self.size += size
+            while len(self.items) > self.max_items or self.size > self.max_size:
+                (old_value, old_size) = self.items.popitem(last=False)[1]
+                self.size -= old_size
+                self.evictions += 1
+
+    def discard(self, key):
+        """Removes an item if present"""
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        self.version += 1
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.items.clear()
+            self.size = 0
+
+    def __getitem__(self, key):
+        """Retrieves an item and makes it the most recently used one.
+           Raises KeyError if the item is not present.
+        """
+        with self.lock:
+            try:
+                item = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SnippetCodec(object):
+    """Compresses encoded snippets with deflate, primed with a dictionary of
+       typical snippets, so that what all snippets repeat (field values, URL 
+       prefixes, peer ids) costs next to nothing, even in a small snippet.
+       Python 2's zlib has no preset dictionaries: instead, the dictionary 
+       is compressed once, and each snippet is compressed (and decompressed)
+       by a copy of that compressor (and decompressor). Every dictionary has 
+       an id, which is stored with the compressed snippet.
+    """
+
+    __slots__ = [ "compressor", "dictionary_id", "decompressors", "added",
+                  "raw_bytes", "stored_bytes", "decoded", "decode_seconds" ]
+
+    def __init__(self):
+        self.compressor     = None    # primed with the latest dictionary
+        self.dictionary_id  = None
+        self.decompressors  = dict()  # dictionary id -> primed decompressor
+        self.added          = 0       # snippets added since opening the cache
+        self.raw_bytes      = 0       # compressed since opening the cache
+        self.stored_bytes   = 0
+        self.decoded        = 0
+        self.decode_seconds = 0.0
+
+    def add_dictionary(self, dictionary_id, dictionary):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)  # raw deflate, no headers
+        primed = compressor.compress(dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        decompressor = zlib.decompressobj(-15)
+        decompressor.decompress(primed)
+        self.decompressors[dictionary_id] = decompressor
+        self.compressor = compressor
+        self.dictionary_id = dictionary_id
+
+    def compress(self, data):
+        """Returns data (see encode_snippet()) compressed, if that is shorter"""
+        self.raw_bytes += len(data)
+        if self.compressor is not None:
+            compressor = self.compressor.copy()
+            compressed = CACHE_CODEC_DEFLATE + chr(self.dictionary_id) + compressor.compress(data) + compressor.flush()
+            if len(compressed) < len(data):
+                data = compressed
+        self.stored_bytes += len(data)
+        return data
+
+    def decompress(self, data):
+        """Returns data as encoded by encode_snippet()"""
+        data = str(data)
+        if data[:1] == CACHE_CODEC_DEFLATE:
+            try:
+                decompressor = self.decompressors[ord(data[1])]
+            except KeyError:
+                raise ValueError('Unknown cache dictionary: ' + repr(data[1]))
+            data = decompressor.copy().decompress(data[2:])
+        return data
+
+    def decode_snippet(self, data, origins):
+        """See decode_snippet(), for compressed snippets as well"""
+        start = time.time()
+        snippet = decode_snippet(self.decompress(data), origins)
+        self.decode_seconds += time.time() - start
+        self.decoded += 1
+        return snippet
+
+    def ratio(self):
+        """Compression ratio of the snippets stored since opening the cache"""
+        if self.stored_bytes:
+            return float(self.raw_bytes) / self.stored_bytes
+        return 1.0
+
+
+class BloomFilter(object):
+    """A set of strings that may answer 'yes' for a string that was never
+       added (see false_positive_rate()), but never 'no' for one that was. 
+       Strings cannot be removed: removed ones are counted as stale, the 
+       owner builds a new filter when there are too many.
+    """
+
+    __slots__ = [ "bits", "size", "capacity", "hashes", "count", "stale" ]
+
+    def __init__(self, capacity, hashes=CACHE_BLOOM_HASHES):
+        """@capacity  number of strings for about 1% false positives"""
+        self.capacity = max(capacity, 1)
+        self.size     = self.capacity * CACHE_BLOOM_BITS  # in bits
+        self.hashes   = hashes
+        self.bits     = bytearray((self.size + 7) / 8)
+        self.count    = 0  # strings added
+        self.stale    = 0  # strings removed
+
+    def _positions(self, key):
+        """The bit positions of key, from one md5 by double hashing"""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        (h1, h2) = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        new = False
+        for position in self._positions(key):
+            bit = 1 << (position & 7)
+            if not self.bits[position >> 3] & bit:
+                self.bits[position >> 3] |= bit
+                new = True
+        if new:
+            self.count += 1
+
+    def false_positive_rate(self):
+        """Estimated chance that a string that was never added is in the filter"""
+        return (1.0 - math.exp(-float(self.hashes) * self.count / self.size)) ** self.hashes
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class PeerDirectory(object):
+    """The peers of a SnipdexCache. Peers are read from the cache file 
+       when they are needed, for instance as the origin of a cached 
+       snippet, and the most recently used ones are kept in memory. So 
+       the time to open a cache and its memory use do not grow with the 
+       number of peers ever seen. Peers that come back unchanged, but for 
+       a newer updated time, are not written again: their times are kept
+       in 'touched', and written in one batch every CACHE_PEER_FLUSH seconds.
+    """
+
+    __slots__ = [ "cache", "hot", "touched", "flushed" ]
+
+    def __init__(self, cache, max_peers):
+        self.cache   = cache
+        self.hot     = LRUCache(max_peers, max_peers)  # pid -> Peer or None (not in the cache)
+        self.touched = dict()       # pid -> updated, of peers that changed nothing else
+        self.flushed = time.time()  # when touched was last taken
+
+    def get_many(self, pids):
+        """Returns a dictionary pid -> Peer with the known peers among pids"""
+        peers = dict()
+        missing = list()
+        for pid in set(pids):
+            try:
+                peer = self.hot[pid]
+            except KeyError:
+                missing.append(pid)
+            else:
+                if peer is not None:
+                    peers[pid] = peer
+        if missing:
+            version = self.hot.version
+            with self.cache.reading() as c:
+                for i in range(0, len(missing), CACHE_MAX_VARIABLES):
+                    chunk = missing[i:i + CACHE_MAX_VARIABLES]
+                    c.execute("select peer, updated from peers where pid in (" + ",".join("?" * len(chunk)) + ")",
+                              chunk)
+                    for row in c:
+                        peer = self._decode(row)
+                        peers[peer.pid] = peer
+            self.hot.put_many([(pid, peers.get(pid), 1) for pid in missing], version)  # unless a writer was first
+        return peers
+
+    def get(self, pid):
+        """Returns the peer with this pid, or None"""
+        return self.get_many([pid]).get(pid)
+
+    def put_many(self, peers):
+        """Remembers stored peers, call inside SnipdexCache.transaction()"""
+        self.hot.put_many([(peer.pid, peer, 1) for peer in peers])
+
+    def touch(self, peers):
+        """Remembers peers that only have a newer updated time, their time
+           is written by the next SnipdexCache._flush_peers()"""
+        for peer in peers:
+            self.touched[peer.pid] = max(peer.updated, self.touched.get(peer.pid))
+        self.hot.put_many([(peer.pid, peer, 1) for peer in peers])
+
+    def take_touched(self):
+        """Returns the touched peers (pid -> updated) and forgets them"""
+        (touched, self.touched) = (self.touched, dict())
+        self.flushed = time.time()
+        return touched
+
+    def flush_due(self):
+        """Tells whether the touched peers have waited CACHE_PEER_FLUSH seconds"""
+        return bool(self.touched) and time.time() - self.flushed >= CACHE_PEER_FLUSH
+
+    def _decode(self, row):
+        """Decodes a (peer, updated) row of the peers table"""
+        peer = decode_peer(row[0])
+        if row[1] is not None:
+            peer.updated = row[1]
+        return peer
+
+    def page(self, first, count):
+        """Returns count peers ordered by pid, starting at first, straight from disk"""
+        with self.cache.reading() as c:
+            c.execute("select peer, updated from peers order by pid limit ? offset ?", (count, first))
+            return [self._decode(row) for row in c]
+
+    def after(self, pid, count, since=None):
+        """Returns count peers following pid, straight from disk, see 
+           SnipdexCache.get_peers_after()
+        """
+        with self.cache.reading() as c:
+            if since is None:
+                c.execute("select peer, updated from peers where pid > ? order by pid limit ?", (pid or '', count))
+            elif pid is None:
+                c.execute("select peer, updated from peers where updated > ? order by updated, pid limit ?", 
+                          (since, count))
+            else:
+                c.execute("select peer, updated from peers where updated >= ? and (updated > ? or pid > ?) "
+                          "order by updated, pid limit ?", (since, since, pid, count))
+            return [self._decode(row) for row in c]
+
+    def discard(self, pid):
+        self.hot.discard(pid)
+
+    def clear(self):
+        self.hot.clear()
+
+    def __contains__(self, pid):
+        return self.get(pid) is not None
+
+    def __len__(self):
+        with self.cache.reading() as c:
+            c.execute("select count(*) from peers")
+            return c.fetchone()[0]
+
+
+class CacheMetrics(object):
+    """Counters and latency histograms of the operations of a cache. 
+       The histograms have a bucket for each of CACHE_LATENCY_BUCKETS. 
+       Nested operations are measured as well, for instance the 
+       response_by_query() inside response_by_query_full().
+    """
+
+    __slots__ = [ "counters", "histograms", "seconds", "lock" ]
+
+    def __init__(self):
+        self.counters   = dict()  # name -> count
+        self.histograms = dict()  # operation -> list of counts per bucket
+        self.seconds    = dict()  # operation -> total seconds
+        self.lock       = Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, operation, seconds):
+        """Records the latency of one operation"""
+        bucket = 0
+        while bucket < len(CACHE_LATENCY_BUCKETS) and seconds > CACHE_LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            if not operation in self.histograms:
+                self.histograms[operation] = [0] * (len(CACHE_LATENCY_BUCKETS) + 1)
+                self.seconds[operation] = 0.0
+            self.histograms[operation][bucket] += 1
+            self.seconds[operation] += seconds
+
+    def snapshot(self):
+        """Returns a dictionary with the counters, and under 'latency' for 
+           each operation its count, mean and (upper bounds of the) median,
+           90th and 99th percentile in seconds, and its histogram
+        """
+        with self.lock:
+            snapshot = dict(self.counters)
+            histograms = dict((operation, list(counts)) for (operation, counts) in self.histograms.items())
+            seconds = dict(self.seconds)
+        latency = dict()
+        for (operation, counts) in histograms.items():
+            total = sum(counts)
+            latency[operation] = {"count": total, "mean": seconds[operation] / total, "buckets": counts}
+            for (name, fraction) in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                seen = 0
+                for (bucket, bucket_count) in enumerate(counts):
+                    seen += bucket_count
+                    if seen >= fraction * total:
+                        break
+                latency[operation][name] = (CACHE_LATENCY_BUCKETS[bucket] if bucket < len(CACHE_LATENCY_BUCKETS) 
+                                            else float('inf'))
+        snapshot["latency"] = latency
+        return snapshot
+
+
+class CacheCompactor(Thread):
+    """Keeps a cache file within its limits, in the background.
+
+       Every interval it removes the snippets and peers that were not stored
+       or updated within the time to live, then the least recently accessed
+       queries until the cache is within max_queries and max_bytes, and 
+       finally returns free pages to the file system (incremental vacuum).
+       All work is done in small transactions on its own connection, so
+       searches are not blocked for long. The queries and peers it removes
+       are reported in 'evicted', for SnipdexCache to forget them.
+       The compactor of the main file of a ShardedCache removes the origins
+       of the peers it removes from the shards as well (see add_shard()).
+    """
+
+    def __init__(self, filename, logger, evicted, interval, max_queries, max_bytes, ttl_days):
+        Thread.__init__(self)
+        self.daemon      = True
+        self.searchable  = False  # the cache has a full text index
+        self.filename    = filename
+        self.logger      = logger
+        self.evicted     = evicted
+        self.interval    = interval
+        self.max_queries = max_queries
+        self.max_bytes   = max_bytes
+        self.ttl_days    = ttl_days
+        self.shards      = []  # (filename, evicted) of each shard, see add_shard()
+        self.stopped     = Event()
+
+    def run(self):
+        cache = sqlite3.connect(self.filename, isolation_level=None)
+        c = cache.execute("select count(*) from sqlite_master where name='snippet_text'")
+        self.searchable = c.fetchone()[0] > 0
+        while not self.stopped.wait(self.interval):
+            try:
+                self.compact(cache.cursor())
+            except sqlite3.Error as ex:
+                self.logger.warning("Warning: Cache compaction failed: " + repr(ex))
+                try:  # else the write lock stays taken
+                    cache.execute("rollback")
+                except sqlite3.OperationalError:
+                    pass  # no transaction was open
+        cache.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def add_shard(self, filename, evicted):
+        """Adds a shard of the cache, which has the origins of its peers"""
+        self.shards.append((filename, evicted))
+
+    def compact(self, c):
+        if self.ttl_days:
+            self.remove_expired(c)
+        self.remove_least_recent(c)
+        c.execute("select sid from snippet_store where sid not in (select sid from postings)")
+        self.remove_snippets(c, [row[0] for row in c.fetchall()])
+        while not self.stopped.is_set() and self.free_pages(c) > 0:
+            c.execute("pragma incremental_vacuum(%d)" % CACHE_VACUUM_PAGES).fetchall() # one page per step
+        c.execute("pragma wal_checkpoint(passive)").fetchall()
+        c.close()
+
+    def remove_expired(self, c):
+        """Removes snippets stored and peers updated before the time to live.
+           The found time of a snippet is not used: peers give any time they like.
+        """
+        expires = str(datetime.datetime.utcnow() - datetime.timedelta(days=self.ttl_days))[:19]
+        c.execute("select sid from snippet_store where stored < ?", (expires, ))
+        self.remove_snippets(c, [row[0] for row in c.fetchall()])
+        c.execute("select pid from peers where updated < ? and pid not in "
+                  "(select pid from origins where query in (?,?))",
+                  (expires, SNIPDEX_QUERY_MYSELF, SNIPDEX_QUERY_REGISTER))
+        pids = [row[0] for row in c.fetchall()]
+        for i in range(0, len(pids), CACHE_MAX_VARIABLES):
+            batch = pids[i:i + CACHE_MAX_VARIABLES]
+            marks = "(" + ",".join("?" * len(batch)) + ")"
+            c.execute("begin immediate")
+            c.execute("select distinct query from origins where pid in " + marks, batch)
+            queries = [row[0] for row in c.fetchall()]
+            c.execute("delete from origins where pid in " + marks, batch)
+            c.execute("delete from term_peers where pid in " + marks, batch)
+            c.execute("delete from peers where pid in " + marks, batch)
+            c.execute("commit")
+            self.evicted.extend(('query', query) for query in queries)
+            self.evicted.extend(('peer', pid) for pid in batch)
+        if pids:
+            for (filename, evicted) in list(self.shards):
+                shard = sqlite3.connect(filename, isolation_level=None)
+                try:
+                    self.remove_origins(shard.cursor(), pids, evicted)
+                finally:
+                    shard.close()
+            self.logger.debug("Cache: removed " + str(len(pids)) + " expired peers")
+
+    def remove_origins(self, c, pids, evicted):
+        """Removes the origins and term peers of removed peers from a shard"""
+        for i in range(0, len(pids), CACHE_MAX_VARIABLES):
+            batch = pids[i:i + CACHE_MAX_VARIABLES]
+            marks = "(" + ",".join("?" * len(batch)) + ")"
+            c.execute("begin immediate")
+            c.execute("select distinct query from origins where pid in " + marks, batch)
+            queries = [row[0] for row in c.fetchall()]
+            c.execute("delete from origins where pid in " + marks, batch)
+            c.execute("delete from term_peers where pid in " + marks, batch)
+            c.execute("commit")
+            evicted.extend(('query', query) for query in queries)
+
+    def remove_snippets(self, c, sids):
+        """Removes snippets from the store and from the queries that refer to them"""
+        for i in range(0, len(sids), CACHE_MAX_VARIABLES):
+            batch = sids[i:i + CACHE_MAX_VARIABLES]
+            marks = "(" + ",".join("?" * len(batch)) + ")"
+            c.execute("begin immediate")
+            c.execute("select distinct query from postings where sid in " + marks, batch)
+            queries = [row[0] for row in c.fetchall()]
+            c.execute("delete from postings where sid in " + marks, batch)
+            c.execute("delete from origins where sid in " + marks, batch)
+            c.execute("delete from snippet_store where sid in " + marks, batch)
+            if self.searchable:
+                c.execute("delete from snippet_text where rowid in " + marks, batch)
+            c.execute("commit")
+            self.evicted.extend(('query', query) for query in queries)
+
+    def remove_least_recent(self, c):
+        """Removes the least recently accessed queries (and terms) until the cache
+           is within its limits. The snippets they leave behind are removed as well.
+        """
+        while not self.stopped.is_set():
+            c.execute("select count(*) from queries")
+            excess = c.fetchone()[0] - self.max_queries
+            if excess <= 0 and self.used_bytes(c) <= self.max_bytes:
+                break
+            batch = min(excess, CACHE_EVICT_BATCH) if excess > 0 else CACHE_EVICT_BATCH  # too many bytes
+            c.execute("select query from queries where query not in (?,?) order by accessed limit ?",
+                      (SNIPDEX_QUERY_MYSELF, SNIPDEX_QUERY_REGISTER, batch))
+            queries = [row[0] for row in c.fetchall()]
+            if not queries:
+                break
+            marks = "(" + ",".join("?" * len(queries)) + ")"
+            c.execute("begin immediate")
+            c.execute("select distinct sid from postings where query in " + marks, queries)
+            sids = [row[0] for row in c.fetchall()]
+            c.execute("delete from postings where query in " + marks, queries)
+            c.execute("delete from origins where query in " + marks, queries)
+            c.execute("delete from term_peers where term in " + marks, queries)
+            c.execute("delete from queries where query in " + marks, queries)
+            c.executemany("delete from snippet_store where sid=? and not exists (select 1 from postings where sid=?)",
+                          [(sid, sid) for sid in sids])
+            if self.searchable:
+                c.executemany("delete from snippet_text where rowid=? and not exists "
+                              "(select 1 from snippet_store where sid=?)", [(sid, sid) for sid in sids])
+            c.execute("commit")
+            self.evicted.extend(('query', query) for query in queries)
+
+    def used_bytes(self, c):
+        page_size = c.execute("pragma page_size").fetchone()[0]
+        page_count = c.execute("pragma page_count").fetchone()[0]
+        return (page_count - self.free_pages(c)) * page_size
+
+    def free_pages(self, c):
+        return c.execute("pragma freelist_count").fetchone()[0]
+
+
+class CacheWriter(Thread):
+    """Writes search responses to a SnipdexCache behind the scenes, so the
+       searcher does not wait for it. Updates for the same normalized query
+       that are still waiting are coalesced into one update. The updates
+       are written in the order of their first arrival, all updates that 
+       are waiting go in one transaction; stop() writes all updates that 
+       are still waiting. If the transaction fails, the updates are written
+       one by one: an update that fails is logged and dropped.
+    """
+
+    def __init__(self, cache, logger):
+        Thread.__init__(self)
+        self.daemon    = True
+        self.cache     = cache
+        self.logger    = logger
+        self.pending   = OrderedDict()  # query_text -> [query, peer_list, snippet_list or None]
+        self.waiting   = Condition()
+        self.stopped   = False
+        self.written   = 0
+        self.coalesced = 0
+
+    def update_response_full(self, query, peer_list, snippet_list):
+        """Queues SnipdexCache.update_response_full(), returns immediately"""
+        self._put(query, peer_list, snippet_list.deepcopy())
+
+    def update_response_backoff(self, query, peer_list):
+        """Queues SnipdexCache.update_response_backoff(), returns immediately"""
+        self._put(query, peer_list, None)
+
+    def _put(self, query, peer_list, snippet_list):
+        query_text = query.normalized().text
+        with self.waiting:
+            if query_text in self.pending:
+                update = self.pending[query_text]
+                update[1].merge(peer_list)
+                if update[2] is None:
+                    update[2] = snippet_list
+                elif snippet_list is not None:
+                    update[2].merge(snippet_list)
+                self.coalesced += 1
+            else:
+                self.pending[query_text] = [query, peer_list.copy(), snippet_list]
+                self.waiting.notify()
+
+    def run(self):
+        while True:
+            with self.waiting:
+                while not self.pending and not self.stopped:
+                    self.waiting.wait()
+                if not self.pending:
+                    break
+                updates = self.pending.values()
+                self.pending.clear()
+            try:
+                self.cache.update_response_full_many(updates)
+                self.written += len(updates)
+            except Exception:  # the batch is rolled back, write the updates one by one
+                for update in updates:
+                    self._write(update)
+
+    def _write(self, update):
+        """Writes a single update, a failure is logged and does not stop the writer"""
+        try:
+            self.cache.update_response_full_many([update])
+            self.written += 1
+        except Exception as ex:
+            self.logger.warning("Warning: Cache update of '" + update[0].normalized().text + "' failed: " + repr(ex))
+
+    def stop(self):
+        """Writes the updates that are still waiting, and stops the thread"""
+        with self.waiting:
+            self.stopped = True
+            self.waiting.notify()
+        self.join()
+
+
+class StatisticsReporter(Thread):
+    """Writes the statistics of a cache (SnipdexCache or ShardedCache) to 
+       the log every interval seconds, and once more on stop().
+    """
+
+    def __init__(self, cache, logger, interval):
+        Thread.__init__(self)
+        self.daemon   = True
+        self.cache    = cache
+        self.logger   = logger
+        self.interval = interval
+        self.stopped  = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+        self.report()
+
+    def report(self):
+        statistics = self.cache.statistics()
+        latency = statistics.pop("latency")
+        self.logger.info("Cache statistics: " + ", ".join(name + "=" + str(statistics[name]) 
+                                                          for name in sorted(statistics)))
+        for operation in sorted(latency):
+            operation_latency = latency[operation]
+            self.logger.info("Cache latency: " + operation + " count=" + str(operation_latency["count"]) + 
+                             ", mean=%.6f, p50<=%s, p90<=%s, p99<=%s" % (operation_latency["mean"], 
+                             operation_latency["p50"], operation_latency["p90"], operation_latency["p99"]))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class NearDuplicates(object):
+    """Finds snippets with almost the same title and summary: their SimHashes
+       (see Snippet.get_fingerprint()) differ in at most a given number of 
+       bits. The 64 bits are split into one band more than that, so near 
+       duplicates have at least one band in common: candidates are found 
+       by a lookup of each band.
+    """
+
+    __slots__ = [ "bits", "bands", "width", "table", "added" ]
+
+    def __init__(self, bits=SNIPPET_NEAR_DUPLICATE_BITS):
+        if not 0 <= bits < 64:
+            raise ValueError("Near duplicates differ in 0 to 63 bits, not: " + repr(bits))
+        self.bits  = bits
+        self.bands = bits + 1
+        self.width = 64 // self.bands  # the last band takes the remaining bits
+        self.table = dict()            # (band, bits of band) -> (number, snippet), in the order added
+        self.added = 0
+
+    def _keys(self, fingerprint):
+        mask = (1 << self.width) - 1
+        keys = [(band, (fingerprint >> (band * self.width)) & mask) for band in range(self.bands - 1)]
+        keys.append((self.bands - 1, fingerprint >> ((self.bands - 1) * self.width)))
+        return keys
+
+    def add(self, snippet):
+        fingerprint = snippet.get_fingerprint()
+        if fingerprint is not None:
+            for key in self._keys(fingerprint):
+                self.table.setdefault(key, []).append((self.added, snippet))
+            self.added += 1
+
+    def find(self, snippet):
+        """Returns the first added near duplicate of snippet, or None"""
+        fingerprint = snippet.get_fingerprint()
+        if fingerprint is None:
+            return None
+        found = None
+        for key in self._keys(fingerprint):
+            for (number, candidate) in self.table.get(key, ()):
+                if bin(candidate.get_fingerprint() ^ fingerprint).count('1') <= self.bits:
+                    if found is None or number < found[0]:
+                        found = (number, candidate)
+                    break
+        return found and found[1]
+
+
 class SnippetList(object):
     """A SnippetList is a ranked list of Snippet objects.
 
@@ -394,16 +2580,22 @@ class SnippetList(object):
         """Our own deepcopy (deepcopy library gives errors)"""
         snippet_list = SnippetList()
         for snippet in self.snippets:
-            snippet_list.append(snippet)
+            snippet_list.append(snippet.copy())
         return snippet_list
 
 
-    def merge(self, other_list):
+    def merge(self, other_list, near_duplicate_bits=None):
         """Merges this list with another list "round robin", but
            skips duplicates based on the signature of each snippet.
 
            @param other_list The other snippetlist to merge.
+           @param near_duplicate_bits If given, near duplicates are skipped as well (see NearDuplicates).
         """
+        near = None
+        if near_duplicate_bits is not None:
+            near = NearDuplicates(near_duplicate_bits)
+            for snippet in self.snippets:
+                near.add(snippet)
         new_snippets = SnippetList()
         nr_merged = len(self.all_origins) 
         if nr_merged < 1:
@@ -418,16 +2610,117 @@ class SnippetList(object):
                 i += 1
             if i % nr_merged == 0 or i >= len_these_snippets:   # TODO: nr_merged instead of 2
                 if j < len_other_snippets:
-                    if self.signatures.has_key(other_list[j].get_signature()):
+                    signature = other_list[j].get_signature()
+                    if self.signatures.has_key(signature):
                         # signatures contains for each url (signature) the index in the original list
-                        self.snippets[self.signatures[other_list[j].get_signature()]].add_origins(other_list[j].origins)
+                        self.snippets[self.signatures[signature]].add_origins(other_list[j].origins)
                     else:
-                        new_snippets.append(other_list[j])
+                        original = near and near.find(other_list[j])
+                        if original:
+                            original.add_origins(other_list[j].origins)
+                        else:
+                            new_snippets.append(other_list[j])
+                            if near:
+                                near.add(other_list[j])
                     j += 1
         self.snippets    = new_snippets.snippets
         self.signatures  = new_snippets.signatures
         self.all_origins = new_snippets.all_origins
 
+    def merge_many(self, other_lists, near_duplicate_bits=None):
+        """Merges this list with several other lists in one pass, weighted 
+           "round robin": in each round, every list gives as many snippets 
+           as it has origins (at least one), so that for a single other list
+           with one origin, the result is that of merge(). Duplicates, based 
+           on the signature of each snippet, are skipped: like in a series
+           of merge() calls, their origins are added to the snippet of the 
+           first list that has it, which keeps its place in the result.
+
+           @param other_lists The other snippetlists to merge.
+           @param near_duplicate_bits If given, near duplicates are skipped as well (see NearDuplicates).
+        """
+        lists   = [self] + list(other_lists)
+        weights = [max(1, len(snippet_list.all_origins)) for snippet_list in lists]
+        signed  = [[(snippet.get_signature(), snippet) for snippet in snippet_list] for snippet_list in lists]
+        first   = dict()  # signature -> (list number, snippet) of its first occurrence
+        near    = NearDuplicates(near_duplicate_bits) if near_duplicate_bits is not None else None
+        for (k, snippets) in enumerate(signed):
+            for (signature, snippet) in snippets:
+                if not signature in first:
+                    original = near and near.find(snippet)
+                    if original:
+                        first[signature] = first[original.get_signature()]
+                    else:
+                        first[signature] = (k, snippet)
+                        if near:
+                            near.add(snippet)
+        positions = [0] * len(lists)
+        new_snippets = SnippetList()
+        active = [k for k in range(len(lists)) if signed[k]]
+        while active:
+            still_active = []
+            for k in active:
+                snippets = signed[k]
+                end = min(positions[k] + weights[k], len(snippets))
+                for (signature, snippet) in snippets[positions[k]:end]:
+                    (owner, first_snippet) = first[signature]
+                    if first_snippet is snippet:
+                        new_snippets.append(snippet)
+                    else:
+                        first_snippet.add_origins(snippet.origins)
+                        for (pid, status, score) in snippet.origins:
+                            new_snippets.all_origins[pid] = 1
+                positions[k] = end
+                if end < len(snippets):
+                    still_active.append(k)
+            active = still_active
+        self.snippets    = new_snippets.snippets
+        self.signatures  = new_snippets.signatures
+        self.all_origins = new_snippets.all_origins
+
+    def fuse(self, other_lists, fusion='rrf', top=SNIPPET_MAX_RESULTS, near_duplicate_bits=None):
+        """Merges this list with several other lists by score: each list adds 
+           the score of the fusion function for the rank of a snippet to its
+           total. Duplicates are folded into their first occurrence, as in
+           merge_many(), but only for the snippets that are kept: the top 
+           ones, selected with a heap of at most top snippets. Ties keep the
+           order of first occurrence.
+
+           @param other_lists The other snippetlists to merge.
+           @param fusion Name of the fusion function (see SNIPPET_FUSIONS).
+           @param top Maximum number of snippets kept.
+           @param near_duplicate_bits If given, near duplicates are folded as well (see NearDuplicates).
+        """
+        score_of = SNIPPET_FUSIONS[fusion]
+        near = NearDuplicates(near_duplicate_bits) if near_duplicate_bits is not None else None
+        first = dict()   # signature -> [total score, first snippet, duplicates]
+        order = []       # the entries of first, in order of first occurrence
+        for snippet_list in [self] + list(other_lists):
+            length = len(snippet_list)
+            for (rank, snippet) in enumerate(snippet_list):
+                signature = snippet.get_signature()
+                entry = first.get(signature)
+                if entry is None:
+                    original = near and near.find(snippet)
+                    if original:
+                        entry = first[signature] = first[original.get_signature()]
+                    else:
+                        entry = first[signature] = [0.0, snippet, []]
+                        order.append(entry)
+                        if near:
+                            near.add(snippet)
+                if entry[1] is not snippet:
+                    entry[2].append(snippet)
+                entry[0] += score_of(rank, length, snippet)
+        new_snippets = SnippetList()
+        for (score, snippet, duplicates) in heapq.nlargest(top, order, key=itemgetter(0)):
+            for duplicate in duplicates:
+                snippet.add_origins(duplicate.origins)
+            new_snippets.append(snippet)
+        self.snippets    = new_snippets.snippets
+        self.signatures  = new_snippets.signatures
+        self.all_origins = new_snippets.all_origins
+
     def trim(self, count):
         """Trims the result list, so that only the first n items remain.
            NOTE: If the length of the list is already smaller, this has no effect
@@ -496,15 +2789,106 @@ class SnippetList(object):
         return len(self.snippets)
 
     def __repr__(self):
-        result = ""
-        count = 0
-        for snippet in self.snippets:
-            if count < 250: # not more than 255 arguments in Python eval()
-                count += 1           
-                if result != "":
-                    result += ", "
-                result += repr(snippet)
-        return "SnippetList(" + result + ")"
+        return "SnippetList(" + ", ".join(repr(snippet) for snippet in self.snippets) + ")"
+
+
+class Origins(object):
+    """The origins of a snippet: (pid, status, score) tuples, at most one 
+       per pid, in the order they were added. Iterates like the list of 
+       tuples it replaces. The positions of the origins are indexed by 
+       pid, so adding an origin takes constant time.
+    """
+
+    __slots__ = [ "entries", "index", "removed" ]
+
+    def __init__(self, origins=()):
+        self.entries = []      # (pid, status, score) tuples, or None where one was removed
+        self.index   = dict()  # pid -> position in entries
+        self.removed = 0
+        for origin in origins:
+            self.append(origin)
+
+    def append(self, origin):
+        """Adds (pid, status, score) at the end, or replaces the origin of pid"""
+        position = self.index.get(origin[0])
+        if position is None:
+            self.index[origin[0]] = len(self.entries)
+            self.entries.append(tuple(origin))
+        else:
+            self.entries[position] = tuple(origin)
+
+    def remove(self, origin):
+        """Removes (pid, status, score), like list.remove()"""
+        position = self.index.get(origin[0])
+        if position is None or self.entries[position] != tuple(origin):
+            raise ValueError("Origins.remove(x): x not in origins")
+        del self.index[origin[0]]
+        self.entries[position] = None
+        self.removed += 1
+
+    def add(self, origin_id, origin_status=None, origin_score=0):
+        """Adds an origin. For a known pid, a higher score or a new status 
+           (other than 'TODO') replaces the origin, and moves it to the end.
+        """
+        position = self.index.get(origin_id)
+        if position is None:
+            self.index[origin_id] = len(self.entries)
+            self.entries.append((origin_id, origin_status, origin_score))
+            return
+        (pid, status, score) = self.entries[position]
+        change = False
+        if origin_score > score: 
+            change = True
+        else:
+            origin_score = score
+        if origin_status and origin_status != 'TODO' and origin_status != status:
+            change = True
+        else:                    
+            origin_status = status
+        if change:
+            self.entries[position] = None
+            self.removed += 1
+            self.index[origin_id] = len(self.entries)
+            self.entries.append((origin_id, origin_status, origin_score))
+            if self.removed > 16 and self.removed > len(self.index):
+                self._compact()
+
+    def _compact(self):
+        """Drops the removed entries"""
+        self.entries = [entry for entry in self.entries if entry is not None]
+        self.index   = dict((entry[0], position) for (position, entry) in enumerate(self.entries))
+        self.removed = 0
+
+    def copy(self):
+        origins = Origins()
+        origins.entries = list(self.entries)
+        origins.index   = dict(self.index)
+        origins.removed = self.removed
+        return origins
+
+    def __iter__(self):
+        for entry in self.entries:
+            if entry is not None:
+                yield entry
+
+    def __getitem__(self, k):
+        return list(self).__getitem__(k)
+
+    def __contains__(self, origin):
+        position = self.index.get(origin[0])
+        return position is not None and self.entries[position] == tuple(origin)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class Snippet(object):
@@ -513,7 +2897,7 @@ class Snippet(object):
     __slots__  = ["origins", "location", "title", "found", 
                   "summary", "extended_summary", 
                   "type", "preview", "geolocation", 
-                  "direct_links", "service_links", "attributes"]
+                  "direct_links", "service_links", "attributes", "signature", "fingerprint"]
 
     def __init__(self, origins, location = None, title = None, found = None, summary = None,
                  extended_summary = None, preview = None, geolocation = None,
@@ -543,13 +2927,21 @@ class Snippet(object):
         self.found            = found
         self.summary          = summary
         self.extended_summary = extended_summary
-        self.origins          = origins
+        self.origins          = origins if type(origins) is Origins else Origins(origins)
+        self.signature        = None  # see get_signature()
+        self.fingerprint      = False # see get_fingerprint()
         self.preview          = preview
         self.geolocation      = geolocation
         self.direct_links     = direct_links
         self.service_links    = service_links
         self.attributes       = attributes
 
+    def copy(self):
+        """Returns a copy of the snippet that shares none of its lists"""
+        return Snippet(self.origins.copy(), self.location, self.title, self.found, self.summary,
+                       self.extended_summary, self.preview, self.geolocation,
+                       list(self.direct_links), list(self.service_links), list(self.attributes))
+
     def add_direct_link(self, description, link):
         self.direct_links.append((description, link))
 
@@ -560,43 +2952,38 @@ class Snippet(object):
         self.attributes.append((key, value))
 
     def add_origin(self, origin_id, origin_status=None, origin_score=0):
-        for (pid, status, score) in self.origins:
-            if pid == origin_id:
-                change = False
-                if origin_score > score: 
-                    change = True
-                else:
-                    origin_score = score
-                if origin_status and origin_status != 'TODO' and origin_status != status:
-                    change = True
-                else:                    
-                    origin_status = status
-                if change:
-                    self.origins.remove((pid, status, score))
-                    self.origins.append((origin_id, origin_status, origin_score))
-                break
-        else:               
-            self.origins.append((origin_id, origin_status, origin_score))
+        self.origins.add(origin_id, origin_status, origin_score)
 
     def add_origins(self, new_origins):
         for (pid, status, score) in new_origins:
             self.add_origin(pid, status, score)
 
     def get_signature(self):
-        if not self.location:  # no location, take the title 
-            return self.title
-        elif self.location.find("://") == -1: # location is not an absolute url
-            return self.location  # TODO: see code in html.py
-        else:
-            location = re.sub("http://www.", "http://", self.location) # frequently used url normalizations
-            location = re.sub("index.html?", "", location)  
-            return location
+        """Returns the key for duplicate detection, computed once: the 
+           canonical location (see canonical_url()), or the title.
+        """
+        if self.signature is None:
+            if not self.location:  # no location, take the title 
+                self.signature = self.title
+            elif self.location.find("://") == -1: # location is not an absolute url
+                self.signature = self.location  # TODO: see code in html.py
+            else:
+                self.signature = canonical_url(self.location)
+        return self.signature
+
+    def get_fingerprint(self):
+        """Returns the SimHash of title and summary, computed once, or None
+           if they are too short (see simhash())
+        """
+        if self.fingerprint is False:
+            self.fingerprint = simhash((self.title or u"") + u" " + (self.summary or u""))
+        return self.fingerprint
 
     def __repr__(self):
         result = ""
         for attribute in Snippet.__slots__:
             value = getattr(self, attribute, "")
-            if value:
+            if value and attribute != "signature" and attribute != "fingerprint":
                 if result != "":
                     result += ","
                 result += attribute + "=" + repr(value)
@@ -648,12 +3035,15 @@ class Snippet(object):
 
 
 class PeerList(object):
-    """A PeerList is a ranked list of Snippet objects.
+    """A PeerList is a ranked list of (peer, status, score) tuples.
+       The positions of the peers are indexed by pid, so merging a
+       peer takes constant time.
     """
-    __slots__ = [ "peers", "pids" ]  # TODO: pids
+    __slots__ = [ "peers", "pids" ]
 
     def __init__(self, *args):
         self.peers = []
+        self.pids  = dict()  # pid -> positions in peers (more than one after append() of the same pid)
         for row in args:
             self.append(row)
 
@@ -662,6 +3052,7 @@ class PeerList(object):
            NOTE: No duplication detection is performed.
            @param peer The snippet to add.
         """
+        self.pids.setdefault(peer.pid, []).append(len(self.peers))
         self.peers.append((peer, status, score))
 
     def merge_single(self, new_peer, new_status='DONE', new_score=1.0):
@@ -670,27 +3061,31 @@ class PeerList(object):
            The status never returns to 'TODO'
            @param peer The peer to add.
         """
-        new_peer_list = PeerList()
-        found = False
-        for (peer, status, score) in self.peers:
-            if peer.pid == new_peer.pid:
-                found = True
-                if peer.older_than(new_peer):
-                    peer = new_peer
-                if score < new_score:
-                    score = new_score
-                if status == 'TODO' and new_status != 'TODO':
-                   status = new_status
-            new_peer_list.append(peer, status, score)
-        if not found:
-            new_peer_list.append(new_peer, new_status, new_score)
-        self.peers = new_peer_list.peers
-            
+        positions = self.pids.get(new_peer.pid)
+        if positions is None:
+            self.append(new_peer, new_status, new_score)
+            return
+        for position in positions:
+            (peer, status, score) = self.peers[position]
+            if peer.older_than(new_peer):
+                peer = new_peer
+            if score < new_score:
+                score = new_score
+            if status == 'TODO' and new_status != 'TODO':
+               status = new_status
+            self.peers[position] = (peer, status, score)
+
+    def copy(self):
+        """A new list with the same peers"""
+        peer_list = PeerList()
+        peer_list.peers = list(self.peers)
+        peer_list.pids  = dict((pid, list(positions)) for (pid, positions) in self.pids.iteritems())
+        return peer_list
 
     def merge(self, peer_list):
-        """Adds new peers to the list if not already present.
+        """Adds new peers to the list if not already present, in time 
+           linear in the length of peer_list.
            @param peer_list The peers to add.
-           TODO: this can be done more efficiently!
         """
         for (peer, status, score) in peer_list:
             self.merge_single(peer, status, score)
@@ -709,15 +3104,7 @@ class PeerList(object):
 
     def __repr__(self): 
         """Representation of peer_list does not show status and score"""
-        result = ""
-        count = 0
-        for (peer, status, score) in self.peers:
-            if count < 250: # not more than 255 arguments in Python eval()
-                count += 1
-                if result != "":
-                    result += ", "
-                result += repr(peer)
-        return "PeerList(" + result + ")"
+        return "PeerList(" + ", ".join(repr(peer) for (peer, status, score) in self.peers) + ")"
 
 
 class Peer(object):
@@ -805,6 +3192,15 @@ class Peer(object):
         else:
             raise ValueError("no open access to peer: " + repr(self.pid))
 
+    def same_as(self, peer):
+        """ See if peer has the same attributes as self, apart from the time
+            it was updated. If so, return True.
+        """
+        for attribute in Peer.__slots__:
+            if attribute != "updated" and getattr(self, attribute) != getattr(peer, attribute):
+                return False
+        return True
+
     def older_than(self, peer):
         """ See if peer was updated later than self, and has a new ip address (or name).
             If so, return Tue.
@@ -874,48 +3270,27 @@ class Peer(object):
 
 
 
-class Query(object):
-    __slots__ = ["query_param"]
-
-    def __init__(self, query_param=None):
-        self.query_param = dict()
-        if query_param:
-            for key in query_param:
-                self.query_param[key] = query_param[key]
-
-    def fill_template_url(self, url, normalize=True):
-        """Puts the query in the urlTemplate HTTP GET url.
-    
-           @return HTTP Get string representation of this Query object.
-        """
-        url = url.replace("&amp;", "&")
-        for key in self.query_param:
-            if normalize and key == 'q':
-                value = self.normalized_text()
-            else:
-                value = self.query_param[key]
-            url = re.sub("{" + key + "\??}", value, url) 
-        url = re.sub("\{[^\}\?]*\?\}", "", url)
-        return url
+class NormalizedQuery(object):
+    """The normalized representation of a Query that is used internally 
+       for searching, computed once (see Query.normalized()). It can include
+       one hashtag term, which is put in front of the query, e.g. '#videos'.
+       Hash tags may be given by the 'h' paramenter. Normalized queries 
+       cannot be changed, so threads may share them.
+       text:     quoted lower case text, e.g. '%23videos+snipdex', the key of the cache
+       terms:    tuple of the quoted terms of text
+       words:    tuple of the terms as unicode, e.g. (u'#videos', u'snipdex')
+       hashtag:  the hashtag as unicode, or u''
+       lower:    the lower case text as unicode, e.g. u'#videos snipdex'
+    """
+    __slots__ = ["text", "terms", "words", "hashtag", "lower"]
 
-    def unicode_text_from_query(self):
-        if 'q' in self.query_param:
-            return urllib.unquote_plus(self.query_param['q']).decode('utf-8', 'ignore')
-        else:
-            return ''
-
-    def normalized_text(self):
-        """ Gives a normalized representation used internally for searching. 
-            The internal representation can include one hashtag term, which
-            is put in front of the query, e.g. '#videos'.
-            Hash tags may be given by the 'h' paramenter
-        """ 
-        if 'q' in self.query_param:
-            text = urllib.unquote_plus(self.query_param['q']) 
+    def __init__(self, query_param):
+        if 'q' in query_param:
+            text = urllib.unquote_plus(query_param['q']) 
         else:
             text = ''
-        if 'h' in self.query_param:
-            tag = urllib.unquote_plus(self.query_param['h'])
+        if 'h' in query_param:
+            tag = urllib.unquote_plus(query_param['h'])
             if tag:
                 if tag[0] != '#':
                     tag = '#' + tag
@@ -943,19 +3318,78 @@ class Query(object):
             text = tag + ' ' + text
         elif tag:
             text = tag
-        return urllib.quote_plus(text.lower())
+        lower = text.lower()
+        quoted = urllib.quote_plus(lower)
+        terms = tuple(quoted.split('+'))
+        set_attribute = super(NormalizedQuery, self).__setattr__
+        set_attribute("text", quoted)
+        set_attribute("terms", terms)
+        set_attribute("words", tuple(urllib.unquote_plus(term).decode('utf-8', 'ignore') for term in terms))
+        set_attribute("hashtag", tag.lower().decode('utf-8', 'ignore'))
+        set_attribute("lower", lower.decode('utf-8', 'ignore'))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NormalizedQuery cannot be changed")
+
+    def __repr__(self):
+        return "NormalizedQuery(" + repr(self.text) + ")"
+
+
+class Query(object):
+    __slots__ = ["query_param", "normalized_query"]
+
+    def __init__(self, query_param=None):
+        self.query_param = dict()
+        self.normalized_query = None  # see normalized()
+        if query_param:
+            for key in query_param:
+                self.query_param[key] = query_param[key]
+
+    def fill_template_url(self, url, normalize=True):
+        """Puts the query in the urlTemplate HTTP GET url.
+    
+           @return HTTP Get string representation of this Query object.
+        """
+        url = url.replace("&amp;", "&")
+        for key in self.query_param:
+            if normalize and key == 'q':
+                value = self.normalized().text
+            else:
+                value = self.query_param[key]
+            url = re.sub("{" + key + "\??}", value, url) 
+        url = re.sub("\{[^\}\?]*\?\}", "", url)
+        return url
+
+    def unicode_text_from_query(self):
+        if 'q' in self.query_param:
+            return urllib.unquote_plus(self.query_param['q']).decode('utf-8', 'ignore')
+        else:
+            return ''
+
+    def normalized(self):
+        """Returns the NormalizedQuery, computed once until the query changes"""
+        normalized_query = self.normalized_query
+        if normalized_query is None:
+            normalized_query = self.normalized_query = NormalizedQuery(self.query_param)
+        return normalized_query
+
+    def normalized_text(self):
+        """Gives the normalized representation used internally for searching,
+           see NormalizedQuery"""
+        return self.normalized().text
 
     def length(self): 
-        query_text = self.normalized_text()
-        return len(query_text.split('+'))
+        return len(self.normalized().terms)
 
     def add_key_value(self, key, value):
         self.query_param[key] = value
+        self.normalized_query = None
 
     def add_query(self, query):
         if query.query_param:
             for key in query.query_param:
                 self.query_param[key] = query.query_param[key]
+            self.normalized_query = None
 
     def get(self, key, default=None):
         return self.query_param.get(key, default)
@@ -964,6 +3398,7 @@ class Query(object):
         return self.query_param.__getitem__(key)
 
     def __setitem__(self, key, value):
+        self.normalized_query = None
         return self.query_param.__setitem__(key, value)
 
     def __iter__(self):
@@ -990,6 +3425,236 @@ if (__name__ == '__main__'):
     logging.basicConfig(level=logging.DEBUG, format="%(name)-11s %(message)s")
     logger.debug("Testing. " + right_now())
 
+    # PeerList: random merges give the same list as the original merge_single()
+    # that rebuilt the list for every peer
+    def reference_merge_single(peers, new_peer, new_status, new_score):
+        result = []
+        found = False
+        for (peer, status, score) in peers:
+            if peer.pid == new_peer.pid:
+                found = True
+                if peer.older_than(new_peer):
+                    peer = new_peer
+                if score < new_score:
+                    score = new_score
+                if status == 'TODO' and new_status != 'TODO':
+                   status = new_status
+            result.append((peer, status, score))
+        if not found:
+            result.append((new_peer, new_status, new_score))
+        return result
+    def random_peer():
+        return (Peer(pid=random.choice("abcdefgh"), updated=random.choice([None, "2012-01-01", "2012-02-01"])),
+                random.choice(['TODO', 'DONE', 'ERROR', 'ME']), random.choice([None, 0.1, 1.0, 2, 3]))
+    differences = 0
+    for trial in range(1000):
+        peer_list = PeerList()
+        reference = []
+        for step in range(random.randint(0, 20)):
+            (peer, status, score) = random_peer()
+            if random.random() < 0.1:  # append does not look for duplicates
+                peer_list.append(peer, status, score)
+                reference.append((peer, status, score))
+            elif random.random() < 0.2:
+                other = PeerList(*[random_peer()[0] for i in range(random.randint(0, 5))])
+                peer_list.merge(other)
+                for (peer, status, score) in other:
+                    reference = reference_merge_single(reference, peer, status, score)
+            else:
+                peer_list.merge_single(peer, status, score)
+                reference = reference_merge_single(reference, peer, status, score)
+        if list(peer_list) != reference or list(peer_list.copy()) != reference:
+            differences += 1
+    logger.debug("PeerList: " + str(differences) + " differences in 1000 random merges")
+    many_peers = PeerList(*[Peer(pid=str(i)) for i in range(500)])
+    start = time.time()
+    for i in range(10):
+        many_peers.copy().merge(PeerList(*[Peer(pid=str(i)) for i in range(250, 750)]))
+    logger.debug("PeerList: merge of 500 into 500 peers in %.2f ms" % ((time.time() - start) * 100))
+
+    # SnippetList: merge_many() of the responses of R peers in one pass, against 
+    # R pairwise merge() calls. Each peer has 10 results, half of them shared.
+    def peer_responses(peers):
+        responses = []
+        for i in range(peers):
+            response = SnippetList(*[Snippet([], location="http://www.snipdex.net/" + 
+                                             (str(i) + "/" if j % 2 else "") + str(j), title=str(j))
+                                     for j in range(10)])
+            response.add_origin("peer" + str(i), 'DONE')
+            responses.append(response)
+        return responses
+    one = SnippetList()
+    one.merge(peer_responses(1)[0])
+    other = SnippetList()
+    other.merge_many(peer_responses(1))
+    logger.debug("SnippetList: merge_many() of one list is merge(): " + str(repr(one) == repr(other)))
+    for peers in (50, 500):
+        pairwise = SnippetList()
+        start = time.time()
+        for response in peer_responses(peers):
+            pairwise.merge(response)
+        pairwise_seconds = time.time() - start
+        one_pass = SnippetList()
+        start = time.time()
+        one_pass.merge_many(peer_responses(peers))
+        logger.debug("SnippetList: %d peers, merge() %.3f s, merge_many() %.3f s, %d and %d snippets" % 
+                     (peers, pairwise_seconds, time.time() - start, len(pairwise), len(one_pass)))
+
+    # Origins: add() against the list scan that Snippet.add_origin() used, 
+    # then merge throughput for snippets that carry 100+ origins
+    def reference_add_origin(origins, origin_id, origin_status=None, origin_score=0):
+        for (pid, status, score) in origins:
+            if pid == origin_id:
+                change = False
+                if origin_score > score: 
+                    change = True
+                else:
+                    origin_score = score
+                if origin_status and origin_status != 'TODO' and origin_status != status:
+                    change = True
+                else:                    
+                    origin_status = status
+                if change:
+                    origins.remove((pid, status, score))
+                    origins.append((origin_id, origin_status, origin_score))
+                break
+        else:               
+            origins.append((origin_id, origin_status, origin_score))
+    differences = 0
+    for trial in range(1000):
+        origins = Origins()
+        reference = []
+        for step in range(random.randint(0, 100)):
+            origin = (random.choice("abcdefghijklmnop"), random.choice([None, 'TODO', 'DONE', 'ERROR']), 
+                      random.choice([0, 1, 2, 3]))
+            origins.add(*origin)
+            reference_add_origin(reference, *origin)
+        if origins != reference or list(origins.copy()) != reference or repr(origins) != repr(reference):
+            differences += 1
+    logger.debug("Origins: " + str(differences) + " differences in 1000 random add_origin() sequences")
+    def crowded_responses(peers, origins):
+        responses = []
+        for i in range(peers):
+            response = SnippetList(*[Snippet([("peer" + str((i + k) % origins), 'DONE', 1) for k in range(origins)], 
+                                             location="http://www.snipdex.net/" + str(j), title=str(j))
+                                     for j in range(10)])
+            responses.append(response)
+        return responses
+    for origins in (100, 400):
+        responses = crowded_responses(100, origins)
+        start = time.time()
+        crowded = SnippetList()
+        crowded.merge_many(responses)
+        merge_seconds = time.time() - start
+        reference = [list(snippet.origins) for snippet in responses[0]]
+        start = time.time()
+        for response in responses[1:]:
+            for (position, snippet) in enumerate(response):
+                for (pid, status, score) in snippet.origins:
+                    reference_add_origin(reference[position], pid, status, score)
+        logger.debug("Origins: 100 responses of 10 snippets with %d origins, merge_many() %.3f s " 
+                     "(%d origins/s), list scan %.3f s, equal: %s" % 
+                     (origins, merge_seconds, 100 * 10 * origins / max(merge_seconds, 1e-6), 
+                      time.time() - start, [list(snippet.origins) for snippet in crowded] == reference))
+
+    # canonical_url(): the same page, and different pages
+    same = [("HTTP://WWW.Snipdex.NET/", "http://snipdex.net"),
+            ("http://www.snipdex.net:80/index.html", "http://snipdex.net"),
+            ("https://snipdex.net:443/about/Default.aspx", "https://snipdex.net/about"),
+            ("http://snipdex.net/?utm_source=feed&q=1&fbclid=x", "http://snipdex.net?q=1"),
+            ("http://snipdex.net/a/?gclid=1", "http://snipdex.net/a")]
+    different = [("http://snipdex.net/A", "http://snipdex.net/a"),
+                 ("http://snipdex.net/index.html.bak", "http://snipdex.net"),
+                 ("http://wwwsnipdex.net", "http://snipdex.net"),
+                 ("http://snipdex.net:8080", "http://snipdex.net"),
+                 ("http://snipdex.net/?q=1", "http://snipdex.net/?q=2")]
+    logger.debug("canonical_url(): %d of %d the same, %d of %d different" % 
+                 (len([1 for (a, b) in same if canonical_url(a) == canonical_url(b)]), len(same),
+                  len([1 for (a, b) in different if canonical_url(a) != canonical_url(b)]), len(different)))
+
+    # NearDuplicates: the banded lookup finds what a scan of all snippets finds, 
+    # then the cost of merging with near duplicate detection. A third of the 
+    # results of each peer are copies of the results of other peers, under 
+    # another url and with one word changed.
+    vocabulary = ["w" + str(i) for i in range(2000)]
+    def random_text(words):
+        return " ".join(random.choice(vocabulary) for i in range(words))
+    texts = [random_text(30) for i in range(200)]
+    snippets = [Snippet([], "http://snipdex.net/" + str(i), texts[i % 100][:30], 
+                        summary=texts[i % 100][30:] + (" changed" if i >= 100 else "")) for i in range(200)]
+    near = NearDuplicates()
+    differences = 0
+    for snippet in snippets:
+        scan = [other for other in snippets[:snippets.index(snippet)] if 
+                bin(other.get_fingerprint() ^ snippet.get_fingerprint()).count('1') <= near.bits]
+        if near.find(snippet) is not (scan[0] if scan else None):
+            differences += 1
+        near.add(snippet)
+    logger.debug("NearDuplicates: %d differences with a scan, %d of 100 copies found" % 
+                 (differences, len([1 for snippet in snippets[100:] if near.find(snippet) is not snippet])))
+    def syndicated_responses(peers):
+        responses = []
+        for i in range(peers):
+            response = SnippetList(*[Snippet([], location="http://peer" + str(i) + ".net/" + str(j), 
+                                             title=str(j), summary=texts[(i + j) % 150] + 
+                                             (" copy" + str(i) if j < 3 else ""))
+                                     for j in range(10)])
+            response.add_origin("peer" + str(i), 'DONE')
+            responses.append(response)
+        return responses
+    for peers in (50, 500):
+        for bits in (None, SNIPPET_NEAR_DUPLICATE_BITS):
+            merged = SnippetList()
+            responses = syndicated_responses(peers)
+            start = time.time()
+            merged.merge_many(responses, bits)
+            logger.debug("NearDuplicates: %d peers, near_duplicate_bits=%s, merge_many() %.3f s, %d snippets" % 
+                         (peers, bits, time.time() - start, len(merged)))
+
+    # SnippetList.fuse(): the heap selects what sorting all fused snippets 
+    # selects, then the cost against merge_many() of the same responses
+    def sorted_fusion(lists, fusion, top):
+        totals = OrderedDict()
+        for snippet_list in lists:
+            for (rank, snippet) in enumerate(snippet_list):
+                totals[snippet.get_signature()] = (totals.get(snippet.get_signature(), 0.0) + 
+                                                   SNIPPET_FUSIONS[fusion](rank, len(snippet_list), snippet))
+        ranked = sorted(totals.items(), key=itemgetter(1), reverse=True)  # stable: ties keep their order
+        return [signature for (signature, total) in ranked[:top]]
+    differences = 0
+    for trial in range(300):
+        lists = [SnippetList(*[Snippet([("peer" + str(k), 'DONE', random.choice([None, 0.1, 1, 2]))], 
+                                       location="http://snipdex.net/" + str(random.randint(0, 30)))
+                               for j in range(random.randint(0, 10))]) for k in range(random.randint(1, 8))]
+        fusion = random.choice(sorted(SNIPPET_FUSIONS))
+        top = random.randint(1, 20)
+        expected = sorted_fusion(lists, fusion, top)
+        fused = lists[0]
+        fused.fuse(lists[1:], fusion, top)
+        if [snippet.get_signature() for snippet in fused] != expected:
+            differences += 1
+    logger.debug("SnippetList: fuse() has %d differences with sorting in 300 random fusions" % differences)
+    for peers in (50, 500):
+        start = time.time()
+        SnippetList().merge_many(peer_responses(peers))
+        merge_seconds = time.time() - start
+        timings = []
+        for fusion in sorted(SNIPPET_FUSIONS):
+            fused = SnippetList()
+            start = time.time()
+            fused.fuse(peer_responses(peers), fusion)
+            timings.append("%s %.3f s" % (fusion, time.time() - start))
+        logger.debug("SnippetList: %d peers, merge_many() %.3f s, fuse(): %s, %d snippets kept" % 
+                     (peers, merge_seconds, ", ".join(timings), len(fused)))
+
+    # Query: the normalized query is computed once, and again after a change
+    query = Query({'q': 'Snipdex  Peer', 'h': 'Videos'})
+    normalized = query.normalized()
+    same = query.normalized() is normalized
+    query['q'] = 'other'
+    logger.debug("Query: " + repr(normalized) + " " + repr(normalized.words) + ", computed once: " + 
+                 str(same) + ", after a change: " + repr(query.normalized()))
+
     # Open cache
     cache = SnipdexCache('/tmp/snipdex-cache-127-0-0-1_8472', logger)
 
@@ -1053,3 +3718,88 @@ if (__name__ == '__main__'):
     #new_snippet_list.merge(snippet_list) # now the non-existing peer should be there again.
     logger.debug("New " + repr(new_snippet_list))
 
+
+    # Write behind: waiting updates for the same query are coalesced
+    writer = CacheWriter(cache, logger)
+    for i in range(3):
+        writer.update_response_full(Query({'q': "snipdexiamback"}), peer_list, snippet_list)
+    writer.start()
+    writer.stop()
+    logger.debug("Writer: " + str(writer.written) + " written, " + str(writer.coalesced) + " coalesced")
+
+    # Freshness: a full update was just fetched, backoff updates are not
+    fresh_query = Query({'q': "snipdex+fresh"})
+    logger.debug("Freshness before: " + repr(cache.freshness(fresh_query)))
+    cache.update_response_full(fresh_query, peer_list, snippet_list)
+    logger.debug("Freshness after: " + repr(cache.freshness(fresh_query)))
+    cache.fresh_seconds = -1
+    logger.debug("Freshness later: " + repr(cache.freshness(fresh_query)))
+    cache.fresh_seconds = CACHE_FRESH_SECONDS
+
+    # Stress: 32 readers while the writer keeps replacing a response. Each 
+    # version of the response has 10 snippets with the version as title: a 
+    # reader should never see two versions mixed, nor an older version.
+    # The in-memory LRU is off, so all reads go to the cache file.
+    cache.close()
+    cache = SnipdexCache('/tmp/snipdex-cache-127-0-0-1_8472', logger, hot_queries=0)
+    stress_query = Query({'q': "snipdex+stress+test"})
+    stress_peer = Peer(pid='SnipdexStressTest')
+    stress_errors = []
+    def stress_response(version):
+        stress_list = SnippetList()
+        for i in range(10):
+            stress_list.append(Snippet([(stress_peer.pid, 'DONE', 1.0)], 
+                                       location="http://www.snipdex.net/" + str(i), title=str(version)))
+        return stress_list
+    def stress_reader():
+        last = 0
+        for i in range(50):
+            (stress_peers, stress_list) = cache.response_by_query_full(stress_query)
+            versions = set(int(snippet.title) for snippet in stress_list)
+            if len(stress_list) != 10 or len(versions) != 1 or min(versions) < last:
+                stress_errors.append(repr(stress_list))
+            else:
+                last = min(versions)
+            cache.get_all_peers_by_page(1)
+    cache.insert_response(stress_query, PeerList(stress_peer), stress_response(0))
+    readers = [Thread(target=stress_reader) for i in range(32)]
+    for reader in readers:
+        reader.start()
+    for version in range(1, 101):
+        stress_peer = Peer(pid='SnipdexStressTest', updated=right_now())
+        cache.insert_response(stress_query, PeerList(stress_peer), stress_response(version))
+    for reader in readers:
+        reader.join()
+    logger.debug("Stress: 32 readers, " + str(len(stress_errors)) + " errors, " + 
+                 str(cache.statistics()["read_connections"]) + " read connections")
+    StatisticsReporter(cache, logger, 0).report()
+
+    # Peers that only come back with a newer time are written in batches
+    for minute in range(10):
+        touched_peer = Peer(pid='SnipdexTouchTest', name="Touch", updated="2020-01-01 00:%02d:00" % minute)
+        cache.update_response_backoff(Query({'q': "snipdex+touch"}), PeerList(touched_peer))
+    statistics = cache.statistics()
+    cache.known_peers.flushed = 0  # due now
+    cache.update_response_backoff(Query({'q': "snipdex+touch"}), PeerList())
+    cache.known_peers.clear()
+    logger.debug("Touch: " + str(statistics.get("peers_written")) + " written, " + 
+                 str(statistics.get("peers_touched")) + " touched, updated " + 
+                 cache.known_peers.get('SnipdexTouchTest').updated)
+    cache.close()
+
+    # Sharding: split the cache into 4 files, the responses stay the same
+    cache = SnipdexCache('/tmp/snipdex-cache-127-0-0-1_8472', logger)
+    shard_queries = [Query({'q': q}) for q in ("muis", "djoerd+hiemstra", "snipdex+stress+test", "snipdex+fresh")]
+    before = [repr(cache.response_by_query_full(query)) for query in shard_queries]
+    my_pid = cache.get_my_peer_id()
+    cache.close()
+    cache = ShardedCache('/tmp/snipdex-cache-127-0-0-1_8472', logger, 4)
+    after = [repr(cache.response_by_query_full(query)) for query in shard_queries]
+    logger.debug("Shards: " + str(sum(b == a for (b, a) in zip(before, after))) + " of " + 
+                 str(len(before)) + " responses equal, my peer id " + str(cache.get_my_peer_id() == my_pid) +
+                 ", search " + str(len(cache.search_snippets(Query({'q': "100"}))[1])) + " snippets")
+    cache.update_response_full(Query({'q': "sharded+cache"}), PeerList(Peer(pid='SnipdexShardTest')), 
+                               stress_response(1))
+    logger.debug("Shards: " + repr(cache.freshness(Query({'q': "sharded+cache"}))) + ", " + 
+                 str(len(cache.response_by_query_full(Query({'q': "sharded"}))[0])) + " peers for a term")
+    cache.close()